@@ -0,0 +1,88 @@
+import hashlib
+import os
+import re
+import sys
+import time
+from pathlib import Path
+
+# Stand-in for gcc / g++ / ar so benchmarks measure cbuild and not the compiler. It understands
+# the arguments the gcc backend passes (-c, -o, -E, -MMD -MF -MT, -I, -x, -include, batches of
+# sources, links and `ar rcs`), writes stub objects and real depfiles and sleeps $FAKE_CC_DELAY
+# seconds per compiled source.
+#
+#   python fake_cc.py cc|ar ARGS...
+INCLUDE = re.compile(r'^\s*#\s*include\s*"([^"]+)"', re.MULTILINE)
+DELAY = float(os.environ.get("FAKE_CC_DELAY", 0))
+
+def includes(source : Path, paths : list[Path], seen : set[Path]) -> list[Path]:
+  # quoted includes, resolved like the real thing: next to the source first, then the include paths
+  with open(source, "r") as fp: content = fp.read()
+
+  found = []
+  for name in INCLUDE.findall(content):
+    header = next((folder / name for folder in [source.parent] + paths if (folder / name).is_file()), None)
+    if header is None or header in seen: continue
+    seen.add(header)
+    found += [header] + includes(header, paths, seen)
+  return found
+
+def write_depfile(depfile : Path, target : str, source : Path, headers : list[Path]):
+  escape = lambda path: str(path).replace(" ", "\\ ")
+  with open(depfile, "w") as fp: fp.write(f"{target}: {" ".join(escape(path) for path in [source] + headers)}\n")
+
+def stub(output : Path, inputs : list[Path]):
+  # the content changes with the inputs, like a real object would
+  hash = hashlib.sha1()
+  for path in inputs:
+    with open(path, "rb") as fp: hash.update(fp.read())
+  with open(output, "w") as fp: fp.write(f"fake {hash.hexdigest()}\n")
+
+def ar(args : list[str]) -> int:
+  _, archive, *objects = args
+  stub(Path(archive), [Path(obj) for obj in objects])
+  return 0
+
+def cc(args : list[str]) -> int:
+  if "--version" in args or "-dumpmachine" in args:
+    print("fake-cc 1.0" if "--version" in args else "fake-none-linux")
+    return 0
+
+  output, depfile, target, paths, sources = None, None, None, [], []
+  values = { "-o", "-MF", "-MT", "-x", "-include", "-include-pch" }
+  index = 0
+  while index < len(args):
+    arg = args[index]
+    if arg in values:
+      value = args[index + 1]
+      if arg == "-o": output = value
+      elif arg == "-MF": depfile = value
+      elif arg == "-MT": target = value
+      index += 2
+      continue
+
+    if arg.startswith("-I"): paths.append(Path(arg[2:]))
+    elif not arg.startswith("-"): sources.append(Path(arg))
+    index += 1
+
+  if "-c" not in args and "-E" not in args:
+    # link, the libraries come after -Wl,--start-group
+    stub(Path(output), sources)
+    os.chmod(output, 0o755)
+    return 0
+
+  for source in sources:
+    headers = includes(source, paths, set())
+    obj = Path(output) if output else Path(source.stem + ".o")
+    if "-MMD" in args: write_depfile(Path(depfile) if depfile else obj.with_suffix(".d"), target or str(obj), source, headers)
+
+    if "-E" in args:
+      for path in [source] + headers:
+        with open(path, "r") as fp: sys.stdout.write(fp.read())
+      continue
+
+    time.sleep(DELAY)
+    stub(obj, [source] + headers)
+  return 0
+
+if __name__ == "__main__":
+  sys.exit(ar(sys.argv[2:]) if sys.argv[1] == "ar" else cc(sys.argv[2:]))
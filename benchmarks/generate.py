@@ -0,0 +1,63 @@
+import os
+import random
+import shutil
+from pathlib import Path
+
+# Synthetic cbuild projects: `targets` c++ libraries in `depth` layers, every library depends on
+# `deps` libraries of the layer below and has `sources` files that include headers of its own
+# and of its dependencies. An `app` executable links everything nobody else depends on. The
+# project files are imported through a tree with at most `imports` imports per project.yaml.
+def generate(folder : Path, targets : int = 50, depth : int = 5, sources : int = 10, deps : int = 2, imports : int = 8, headers : int = 2, seed : int = 0) -> Path:
+  rng = random.Random(seed)
+  folder = Path(folder)
+  shutil.rmtree(folder, ignore_errors=True)
+
+  depth = max(1, min(depth, targets))
+  names = [f"t{index:04}" for index in range(targets)]
+  layers = [[name for index, name in enumerate(names) if index * depth // targets == layer] for layer in range(depth)]
+
+  dependencies : dict[str, list[str]] = {}
+  for layer, members in enumerate(layers):
+    for name in members:
+      dependencies[name] = sorted(rng.sample(layers[layer - 1], min(deps, len(layers[layer - 1])))) if layer > 0 else []
+
+  for name in names:
+    root = folder / name
+    os.makedirs(root / "src", exist_ok=True)
+    os.makedirs(root / "include" / name, exist_ok=True)
+
+    for header in range(headers):
+      with open(root / "include" / name / f"h{header}.h", "w") as fp:
+        fp.write(f"#pragma once\ninline int {name}_h{header}() {{ return {header}; }}\n")
+
+    for source in range(sources):
+      used = [f"{name}/h{source % headers}.h"] + [f"{dependency}/h{rng.randrange(headers)}.h" for dependency in dependencies[name]]
+      with open(root / "src" / f"s{source}.cpp", "w") as fp:
+        fp.write("".join(f"#include \"{header}\"\n" for header in used) + f"int {name}_s{source}() {{ return {source}; }}\n")
+
+    # the include folders of the dependencies are handed on by cbuild
+    with open(root / "project.yaml", "w") as fp:
+      fp.write(f"({name}):\n  type: c++\n  kind: lib\n  sources: src/*.cpp\n  includes: include\n")
+      if dependencies[name]: fp.write(f"  depends: [{", ".join(dependencies[name])}]\n")
+
+  # import tree, every project.yaml imports at most `imports` folders
+  level, group = [folder / name for name in names], 0
+  while len(level) > imports:
+    parents = []
+    for start in range(0, len(level), imports):
+      parent = folder / "groups" / f"g{group:04}"
+      group += 1
+      os.makedirs(parent, exist_ok=True)
+      with open(parent / "project.yaml", "w") as fp:
+        fp.write("import:\n" + "".join(f"  - {Path(os.path.relpath(child, parent)).as_posix()}\n" for child in level[start:start + imports]))
+      parents.append(parent)
+    level = parents
+
+  used = { dependency for name in names for dependency in dependencies[name] }
+  os.makedirs(folder / "app", exist_ok=True)
+  with open(folder / "app" / "main.cpp", "w") as fp: fp.write("int main() { return 0; }\n")
+  with open(folder / "project.yaml", "w") as fp:
+    fp.write("$StartProject: app\nimport:\n" + "".join(f"  - {Path(os.path.relpath(child, folder)).as_posix()}\n" for child in level))
+    fp.write(f"(app):\n  type: c++\n  kind: exe\n  sources: app/*.cpp\n  depends: [{", ".join(name for name in names if name not in used)}]\n")
+
+  return folder
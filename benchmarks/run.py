@@ -0,0 +1,160 @@
+import argparse
+import datetime
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+from generate import generate
+
+# Measures the overhead of cbuild itself on a generated project built with the stand-in compiler
+# (fake_cc.py): clean build, no-op build, rebuild after touching one source of a leaf library,
+# project load time (with and without the snapshot) and the peak memory of a clean build. Every
+# run is appended to a jsonl file, --compare shows the latest run against earlier ones.
+#
+#   python benchmarks/run.py --targets 300 --depth 8 --sources 10
+#   python benchmarks/run.py --compare
+REPO = Path(__file__).resolve().parent.parent
+RESULTS = Path(__file__).resolve().parent / "results.jsonl"
+METRICS = ["clean", "noop", "touch", "load", "load_cold", "peak_rss_mb"]
+
+def toolchain(folder : Path) -> dict[str, str]:
+  # wrappers named like the real tools, the gcc backend runs them through $CC, $CXX and $AR
+  fake = Path(__file__).resolve().parent / "fake_cc.py"
+  tools = {}
+  for variable, name, mode in [("CC", "cc", "cc"), ("CXX", "c++", "cc"), ("AR", "ar", "ar")]:
+    if sys.platform == "win32":
+      wrapper = folder / f"{name}.bat"
+      with open(wrapper, "w") as fp: fp.write(f"@\"{sys.executable}\" \"{fake}\" {mode} %*\n")
+    else:
+      wrapper = folder / name
+      with open(wrapper, "w") as fp: fp.write(f"#!/bin/sh\nexec \"{sys.executable}\" \"{fake}\" {mode} \"$@\"\n")
+      os.chmod(wrapper, 0o755)
+    tools[variable] = str(wrapper)
+  return tools
+
+def environment(tools : dict[str, str], jobs : int, delay : float) -> dict[str, str]:
+  env = { key : value for key, value in os.environ.items() if not key.startswith("CBUILD_") }
+  env.update(tools)
+  env.update({ "PYTHONPATH" : str(REPO), "FAKE_CC_DELAY" : str(delay) })
+  if jobs: env["CBUILD_JOBS"] = str(jobs)
+  return env
+
+def run(command : list[str], cwd : Path, env : dict[str, str]) -> tuple[float, float | None]:
+  # wall time and peak resident memory (MiB, posix only) of one process
+  start = time.perf_counter()
+  process = subprocess.Popen(command, cwd=cwd, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+  if hasattr(os, "wait4"):
+    _, status, usage = os.wait4(process.pid, 0)
+    process.returncode = os.waitstatus_to_exitcode(status)
+    # kilobytes on linux, bytes on macos
+    peak = usage.ru_maxrss / (1 << 20 if sys.platform == "darwin" else 1 << 10)
+  else:
+    process.wait()
+    peak = None
+  elapsed = time.perf_counter() - start
+
+  if process.returncode:
+    print(process.stderr.read().decode(errors="replace"))
+    sys.exit(f"{" ".join(command)} failed with {process.returncode}")
+  return elapsed, peak
+
+def clean(project : Path):
+  for root, folders, _ in os.walk(project):
+    for name in [name for name in folders if name in ("bin", ".cbuild")]:
+      shutil.rmtree(Path(root) / name)
+      folders.remove(name)
+
+def measure(project : Path, env : dict[str, str], repeat : int) -> dict[str, float]:
+  cbuild = [sys.executable, "-m", "cbuild"]
+  load = [sys.executable, "-c", "import time; start = time.perf_counter(); from cbuild.project import Project; Project('.'); print(time.perf_counter() - start)"]
+  touched = project / "t0000" / "src" / "s0.cpp"
+
+  samples = { metric : [] for metric in METRICS }
+  for _ in range(repeat):
+    clean(project)
+    # loading time is taken inside the process, without the interpreter start up
+    samples["load_cold"].append(float(subprocess.run(load, cwd=project, env=env, capture_output=True, text=True, check=True).stdout))
+
+    elapsed, peak = run(cbuild, project, env)
+    samples["clean"].append(elapsed)
+    if peak is not None: samples["peak_rss_mb"].append(peak)
+
+    samples["load"].append(float(subprocess.run(load, cwd=project, env=env, capture_output=True, text=True, check=True).stdout))
+    samples["noop"].append(run(cbuild, project, env)[0])
+
+    os.utime(touched)
+    samples["touch"].append(run(cbuild, project, env)[0])
+
+  return { metric : statistics.median(values) for metric, values in samples.items() if values }
+
+def commit() -> str | None:
+  try: return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=REPO, capture_output=True, text=True, check=True).stdout.strip()
+  except (OSError, subprocess.CalledProcessError): return None
+
+def compare(results : Path, count : int):
+  with open(results, "r") as fp: runs = [json.loads(line) for line in fp if line.strip()]
+  if not runs:
+    print("No results yet")
+    return
+
+  # only runs of the same synthetic project are comparable
+  latest = runs[-1]
+  history = [run for run in runs[:-1] if run["params"] == latest["params"]][-count:]
+  print(f"params: {json.dumps(latest["params"])}")
+
+  header = f"{"":12}" + "".join(f"{run["commit"] or "?":>12}" for run in history) + f"{(latest["commit"] or "?") + "*":>12}"
+  print(header)
+  for metric in METRICS:
+    if metric not in latest["metrics"]: continue
+    values = [run["metrics"].get(metric) for run in history]
+    row = f"{metric:12}" + "".join(f"{value:12.3f}" if value is not None else f"{"-":>12}" for value in values)
+    row += f"{latest["metrics"][metric]:12.3f}"
+    if values and values[-1]: row += f"  {(latest["metrics"][metric] / values[-1] - 1) * 100:+.1f}%"
+    print(row)
+
+def main():
+  parser = argparse.ArgumentParser(description="cbuild overhead benchmark")
+  parser.add_argument("--targets", type=int, default=50)
+  parser.add_argument("--depth", type=int, default=5)
+  parser.add_argument("--sources", type=int, default=10, help="sources per target")
+  parser.add_argument("--deps", type=int, default=2, help="dependencies per target on the layer below")
+  parser.add_argument("--imports", type=int, default=8, help="imports per project.yaml")
+  parser.add_argument("--delay", type=float, default=0, help="seconds the fake compiler sleeps per source")
+  parser.add_argument("-j", "--jobs", type=int, default=None)
+  parser.add_argument("--repeat", type=int, default=3)
+  parser.add_argument("--workdir", default=None, help="where the project is generated (default: a temporary folder)")
+  parser.add_argument("--results", default=str(RESULTS))
+  parser.add_argument("--compare", nargs="?", const=5, type=int, default=None, metavar="N", help="compare the latest run with the N previous ones of the same project")
+  args = parser.parse_args()
+
+  if args.compare is not None: return compare(Path(args.results), args.compare)
+
+  params = { "targets" : args.targets, "depth" : args.depth, "sources" : args.sources, "deps" : args.deps, "imports" : args.imports, "delay" : args.delay, "jobs" : args.jobs }
+  with tempfile.TemporaryDirectory(prefix="cbuild-bench-") as temp:
+    workdir = Path(args.workdir or temp)
+    project = generate(workdir / "project", args.targets, args.depth, args.sources, args.deps, args.imports)
+    env = environment(toolchain(workdir), args.jobs, args.delay)
+    metrics = measure(project, env, args.repeat)
+
+  result = {
+    "time" : datetime.datetime.now().isoformat(timespec="seconds"),
+    "commit" : commit(),
+    "python" : platform.python_version(),
+    "platform" : platform.platform(),
+    "params" : params,
+    "metrics" : metrics
+  }
+  with open(args.results, "a") as fp: fp.write(json.dumps(result) + "\n")
+
+  for metric in METRICS:
+    if metric in metrics: print(f"{metric:12} {metrics[metric]:10.3f}{" MiB" if metric == "peak_rss_mb" else " s"}")
+  compare(Path(args.results), 5)
+
+if __name__ == "__main__":
+  main()
@@ -1,2 +1,12 @@
 import os 
-CBUILD_INSTALL_DIR = __path__[0]
\ No newline at end of file
+import sys
+CBUILD_INSTALL_DIR = __path__[0]
+
+def _user_dir() -> str:
+  # caches of the machine (toolchain probes...), the install folder may belong to another user
+  if sys.platform == "win32": base = os.environ.get("LOCALAPPDATA", None) or os.path.expanduser("~/AppData/Local")
+  elif sys.platform == "darwin": base = os.path.expanduser("~/Library/Caches")
+  else: base = os.environ.get("XDG_CACHE_HOME", None) or os.path.expanduser("~/.cache")
+  return os.path.join(base, "cbuild")
+
+CBUILD_USER_DIR = _user_dir()
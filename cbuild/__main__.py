@@ -1,2 +1,24 @@
-from cbuild import cbuild 
-cbuild.main()
\ No newline at end of file
+import sys
+import time
+from cbuild import daemon, journal
+
+# entry point of `cbuild` and `python -m cbuild`, only the journal and the build server client are
+# imported before it is clear that this process has to build itself
+def main():
+  start = time.monotonic()
+  # nothing changed since the last successful build, not even the toolchain has to be looked at
+  if journal.enabled(sys.argv[1:]) and journal.is_up_to_date():
+    print("Up to date, execution took", time.monotonic() - start, "seconds")
+    sys.exit(0)
+
+  # with the build server enabled this process only forwards the arguments and prints the output
+  if daemon.enabled(sys.argv[1:]):
+    if (code := daemon.request(sys.argv[1:])) is not None: sys.exit(code)
+    from cbuild.log import warn
+    warn("The build server could not be reached (see .cbuild/daemon.log), building in this process")
+
+  from cbuild import cbuild
+  cbuild.main()
+
+if __name__ == "__main__":
+  main()
@@ -2,6 +2,8 @@
 
 import json
 import os
+import sqlite3
+import threading
 from pathlib import Path
 from typing import Any
 
@@ -9,30 +11,71 @@ class CacheJsonEncoder(json.JSONEncoder):
   def default(self, obj):
     return obj.as_posix() if isinstance(obj, Path) else super().default(obj)
 
+# Key value store backed by sqlite, every write is its own transaction so only the changed
+# key is written, a crash never leaves a half written file and sqlite's file locking lets
+# parallel builds share one cache. Values are stored as json.
 class CacheFile:
+  SQLITE_HEADER = b"SQLite format 3\0"
+
   def __init__(self, file_path : Path) -> None:
 
     self.file = file_path if isinstance(file_path, Path) else Path(file_path)
-    
+
     if not os.path.isdir(self.file.parent): os.makedirs(self.file.parent, exist_ok=True)
-    if not os.path.exists(self.file): self.file.touch()
+    legacy = self._read_legacy()
 
-    with open(self.file, "r") as fp:
-      self.content = json.loads(fp.read() or "{}")
+    self._lock = threading.Lock()
+    self._connection = sqlite3.connect(self.file, timeout=60, isolation_level=None, check_same_thread=False)
+    self._connection.execute("PRAGMA journal_mode=WAL")
+    self._connection.execute("PRAGMA synchronous=NORMAL")
+    self._connection.execute("CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
 
-  def __del__(self): 
-    if not os.path.isdir(self.file.parent): os.makedirs(self.file.parent, exist_ok=True)
-    if not os.path.exists(self.file): self.file.touch()
+    if legacy: self.update(legacy)
+
+  def _read_legacy(self) -> dict[str, Any]:
+    # caches used to be one json document, convert them in place
+    if not os.path.isfile(self.file): return {}
+    with open(self.file, "rb") as fp:
+      if fp.read(len(CacheFile.SQLITE_HEADER)) in (CacheFile.SQLITE_HEADER, b""): return {}
+      fp.seek(0)
+      try: content = json.loads(fp.read() or "{}")
+      except ValueError: content = {}
+
+    os.remove(self.file)
+    return content
 
-    with open(self.file, "w") as fp:
-      json.dump(self.content, fp=fp, indent=2, cls=CacheJsonEncoder)
+  def close(self):
+    with self._lock: self._connection.close()
+
+  def __del__(self):
+    if hasattr(self, "_connection"): self.close()
 
   def __getitem__(self, key : str):
-    if key not in self.content: return None
-    return self.content[key]
-  
+    with self._lock:
+      row = self._connection.execute("SELECT value FROM cache WHERE key = ?", (key,)).fetchone()
+    return json.loads(row[0]) if row is not None else None
+
   def __setitem__(self, key : str, value : Any):
-    self.content[key] = value
+    self.update({ key : value })
 
   def __contains__(self, key : str):
-    return key in self.content
\ No newline at end of file
+    with self._lock:
+      return self._connection.execute("SELECT 1 FROM cache WHERE key = ?", (key,)).fetchone() is not None
+
+  def items(self) -> dict[str, Any]:
+    with self._lock:
+      rows = self._connection.execute("SELECT key, value FROM cache").fetchall()
+    return { key : json.loads(value) for key, value in rows }
+
+  def update(self, content : dict[str, Any]):
+    rows = [(key, json.dumps(value, cls=CacheJsonEncoder)) for key, value in content.items()]
+    with self._lock:
+      with self._connection:
+        self._connection.execute("BEGIN IMMEDIATE")
+        self._connection.executemany("INSERT OR REPLACE INTO cache (key, value) VALUES (?, ?)", rows)
+
+  def remove(self, keys : list[str]):
+    with self._lock:
+      with self._connection:
+        self._connection.execute("BEGIN IMMEDIATE")
+        self._connection.executemany("DELETE FROM cache WHERE key = ?", [(key,) for key in keys])
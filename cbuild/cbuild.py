@@ -1,9 +1,17 @@
+import argparse
+import os
 import time
-from cbuild.compiler import CompileError, CompileResult, Compiler
+from cbuild.compiler import CompileError, CompileResult, Compiler, forget_sources
+from cbuild.distributed import DEFAULT_HOST, DEFAULT_PORT, CompileWorker, WorkerPool
+from cbuild.graph import BuildGraph
+from cbuild.history import DurationHistory
+from cbuild.journal import BuildJournal
 from cbuild.log import log, error
-from cbuild.processes import Program
-from cbuild.vstoolchain import VSInstallation
+from cbuild.objcache import ObjectCache
+from cbuild.processes import ProcessEngine
 from cbuild.project import Project, Target
+from cbuild.scheduler import JobScheduler
+from cbuild.trace import Tracer, span
 import sys
 def _tree(target:Target):
   if len(target._dependencies) == 0: return [f"═ {target.name}"]
@@ -24,32 +32,116 @@ def print_tree(target:Target):
 
 
 def compile_target(target : Target) -> CompileResult:
-  result = CompileResult()
-  for child in target._dependencies:
-    res = compile_target(child)
-    if res.error(): return res
-    result += res
+  return BuildGraph(target).execute(Compiler.Compile)
 
-  return Compiler.Compile(target, result)
+
+def parse_args(argv : list[str] = None) -> argparse.Namespace:
+  parser = argparse.ArgumentParser(prog="cbuild")
+  parser.add_argument("command", nargs="?", default="build", choices=["build", "watch", "serve", "worker"], help="build once (default), keep rebuilding on every change, run the build server or a remote compile worker")
+  parser.add_argument("--daemon", action="store_true", help="build through a background server that keeps the project loaded (also $CBUILD_DAEMON=1)")
+  parser.add_argument("-j", "--jobs", type=int, default=None, help="number of parallel jobs (default: $CBUILD_JOBS or the number of cores)")
+  parser.add_argument("--cache-dir", default=None, help="shared object cache folder (default: $CBUILD_CACHE_DIR, disabled if unset)")
+  parser.add_argument("--trace", default=None, metavar="FILE", help="write a chrome trace event file (chrome://tracing, ui.perfetto.dev) and print a timing summary")
+  parser.add_argument("--cache-size", default=None, help=f"object cache size limit e.g. 500M (default: $CBUILD_CACHE_SIZE or {ObjectCache.DEFAULT_SIZE})")
+  parser.add_argument("--workers", default=None, metavar="HOST:PORT,...", help="compile on remote workers (default: $CBUILD_WORKERS, needs $CBUILD_WORKER_KEY)")
+  parser.add_argument("--host", default=None, metavar="HOST[:PORT]", help=f"address `cbuild worker` listens on, other machines only reach it with an explicit host (default: {DEFAULT_HOST}:{DEFAULT_PORT})")
+  parser.add_argument("--fail-fast", action="store_true", help="stop at the first failed compile, running compiles are killed (same as --keep-going 1)")
+  parser.add_argument("--keep-going", type=int, default=None, metavar="N", help="stop after N failed compiles (default: build everything that does not depend on a failed target)")
+  parser.add_argument("--memory-budget", default=None, metavar="SIZE", help="only start jobs while the peak memory recorded for them fits e.g. 16G (default: $CBUILD_MEMORY_BUDGET or the memory available when the build starts)")
+  parser.add_argument("--config", default=None, type=lambda names: names.split(","), metavar="NAME,...", help="build only these of the configurations declared in project.yaml (default: all of them)")
+  parser.add_argument("--timeout", type=float, default=None, metavar="SECONDS", help="kill compilers, linkers... running longer than this (default: $CBUILD_TIMEOUT, no limit if unset)")
+  return parser.parse_args(argv)
+
+
+def activate_toolchain():
+  # msvc needs its environment set up, gcc / clang are used straight from the PATH (or $CC, $CXX)
+  if sys.platform != "win32": return
+
+  from cbuild.vstoolchain import VSInstallation
+  installation = VSInstallation.latest(VSInstallation.find_installations())
+  if installation is not None: installation.activate()
+
+
+def configure(args : argparse.Namespace):
+  Tracer.Init(args.trace)
+  ProcessEngine.Init(args.timeout)
+  # the slots of the remote workers are added to the local ones
+  workers = WorkerPool.Init(args.workers)
+  jobs = args.jobs or (JobScheduler.default_jobs() + workers.slots() if workers is not None else None)
+  memory = args.memory_budget or os.environ.get("CBUILD_MEMORY_BUDGET", None)
+  JobScheduler.Init(jobs, 1 if args.fail_fast else args.keep_going or None, ObjectCache.parse_size(memory) if memory else None)
+  ObjectCache.Init(args.cache_dir, args.cache_size)
+  DurationHistory.Init()
+
+
+def build(project : Project, configurations : list[str] = None) -> CompileResult:
+  # one build of the start target, run by the command line and by the build server. All
+  # configurations (or the selected ones) are built by one graph, their jobs share the pool
+  target = project.get_start_target()
+  print_tree(target)
+
+  roots = project.get_start_targets(configurations)
+  if roots[0].configuration is not None: log(f"Configurations {", ".join(root.configuration for root in roots)}")
+
+  graph = BuildGraph(*roots)
+  with span("initialize compilers", "startup"):
+    Compiler.Init({ t.type for t in graph.targets })
+
+  BuildJournal.Init()
+  forget_sources()
+  DurationHistory.instance.plan(graph.targets)
+  start = time.monotonic()
+  result = graph.execute(Compiler.Compile)
+  # the next run exits right away if nothing of this build changes, unless it only built some configurations
+  if not result.error() and configurations is None: BuildJournal.instance.write(project._stamps())
+
+  if (predicted := DurationHistory.instance.predicted(JobScheduler.Get().jobs)) is not None:
+    log(f"Jobs took {time.monotonic() - start:.2f} seconds, {predicted:.2f} predicted")
+  DurationHistory.instance.write()
+
+  if ObjectCache.instance is not None:
+    hits, misses = ObjectCache.instance.hits, ObjectCache.instance.misses
+    total_hits, total_misses = ObjectCache.instance.flush()
+    log(f"Object cache: {hits} hits, {misses} misses ({total_hits} hits, {total_misses} misses in total)")
+
+  if Tracer.instance is not None:
+    Tracer.instance.write()
+    print(Tracer.instance.summary())
+    log(f"Trace written to {Tracer.instance.file}")
+
+  return result
 
 
 def main():
   glob_start = time.monotonic()
+  args = parse_args()
+  if args.command == "worker":
+    try: CompileWorker(args.host).serve()
+    except KeyboardInterrupt: pass
+    return
+
+  configure(args)
 
   # step one find compilers :)
-  installations : list[VSInstallation] = VSInstallation.find_installations()
-  installation = installations[1]
-  installation.activate()
+  with span("activate toolchain", "startup"):
+    activate_toolchain()
 
-  # Create project and determine start target
-  project = Project(".")
-  target = project.get_start_target()
-  print_tree(target)
+  if args.command == "watch":
+    from cbuild.watch import WatchSession
+    try: WatchSession(".", args.config).run()
+    except KeyboardInterrupt: pass
+    return
 
-  Compiler.Init()
+  if args.command == "serve":
+    from cbuild.daemon import BuildServer
+    BuildServer(".").serve()
+    return
+
+  # Create project and determine start target
+  with span("load project", "startup"):
+    project = Project(".")
 
-    
-  result = compile_target(target)
+  result = build(project, args.config)
 
   if result.error():
     error(result)
@@ -1,10 +1,18 @@
 import abc
+import importlib
+import sys
+import threading
+from concurrent.futures import Future
 from dataclasses import dataclass, field
+from glob import glob
 from os import system
 from pathlib import Path
 import re
-from typing import Any, Optional, Self
+from typing import Any, Callable, Optional, Self
+from cbuild.log import error
 from cbuild.project import Target
+from cbuild.scheduler import JobScheduler
+from cbuild import journal
 
 
 #
@@ -19,7 +27,9 @@ class CompileResult:
     self.pch_files = pch_files
 
   def __add__(self, other : Self) -> "CompileResult":
-    return CompileResult(self.includes + other.includes, self.static_lib + other.static_lib, pch_files=self.pch_files + other.pch_files)
+    # dependencies shared by several targets (diamonds) must only show up once
+    unique = lambda x, y: list(dict.fromkeys(x + y))
+    return CompileResult(unique(self.includes, other.includes), unique(self.static_lib, other.static_lib), pch_files=unique(self.pch_files, other.pch_files))
   
   def error(self):
     return False
@@ -59,6 +69,10 @@ class CompileErrorEntry:
 
   def __post_init__(self):
     self.sort_index = self.line
+
+  @property
+  def is_error(self) -> bool:
+    return self.code.startswith(("error", "fatal error"))
   
   def __repr__(self) -> str:
     return f"   line {self.line} : {self.code} {self.message})\n"
@@ -68,12 +82,8 @@ class CompileError(CompileResult):
     self.files : dict[Path, CompileErrorEntry]= {}
 
   def add_entry(self, file : Path, entry : CompileErrorEntry):
-    
-    if file not in self.files:
-      self.files[file] = [entry]
-
-    else:
-      self.files[file] += [entry]
+    # entries arrive from the process thread while the compile is still running
+    self.files.setdefault(file, []).append(entry)
 
   def add_error(self, file : Path, line : int, message : str, code : str):
     self.add_entry(file, CompileErrorEntry(line,code,message))
@@ -93,16 +103,100 @@ class CompileError(CompileResult):
         message += str(error)
     return message 
 
+class Diagnostics:
+  # on_output callback of a compiler process, its diagnostics are parsed while it still runs so
+  # errors show up (and count against --fail-fast / --keep-going) as soon as they are printed.
+  # Warnings are held back and only reported if the compile fails
+  def __init__(self, errors : CompileError, parse : Callable[[str], tuple[Path, CompileErrorEntry]]) -> None:
+    self.errors = errors
+    self.parse = parse
+    self.failed = False
+    self.reported = False
+    self._pending : list[tuple[Path, CompileErrorEntry]] = []
+    self._lock = threading.Lock()
+
+  def __call__(self, stream : str, line : str):
+    file, entry = self.parse(line.rstrip("\n"))
+    if file is None: return
+    with self._lock: self._pending.append((file, entry))
+    if self.failed or entry.is_error: self.fail()
+
+  def fail(self) -> bool:
+    # also called once the process exited with an error, False if it printed no diagnostic at all (crash, timeout)
+    with self._lock:
+      first, self.failed = not self.failed, True
+      pending, self._pending = self._pending, []
+      self.reported = self.reported or bool(pending)
+
+    for file, entry in pending: self.report(file, entry)
+    if first: JobScheduler.Get().failed()
+    return self.reported
+
+  def report(self, file : Path, entry : CompileErrorEntry):
+    self.errors.add_entry(file, entry)
+    if entry.is_error: error(f"{file}:{entry.line}: {entry.code}: {entry.message}", fatal=False)
+
+def compile_batches(units : list[tuple[Path, Path, str]], limit : int, jobs : int) -> list[list[tuple[Path, Path, str]]]:
+  # (source, object, command) units are batched per output folder, a batch is small enough
+  # that every job slot still gets work but never bigger than the configured limit
+  size = max(1, min(limit, -(-len(units) // jobs)))
+  folders : dict[Path, list] = {}
+  for unit in units: folders.setdefault(unit[1].parent, []).append(unit)
+  return [group[i:i + size] for group in folders.values() for i in range(0, len(group), size)]
+
+# the sources of a target are globbed once per build, its configurations share them
+_sources : dict[tuple[Path, tuple[str, ...]], Future] = {}
+_sources_lock = threading.Lock()
+
+def find_sources(target : Target, patterns : list[str]) -> list[Path]:
+  key = (target.root, tuple(patterns))
+  with _sources_lock:
+    found, owner = _sources.get(key, None), key not in _sources
+    if owner: found = _sources[key] = Future()
+  if not owner: return found.result()
+
+  try:
+    journal.record_sources(target.root, patterns, target.get_output_dir())
+    found.set_result([Path(file) for pattern in patterns for file in glob(pattern, root_dir=target.root, recursive=True)])
+  except BaseException as e: found.set_exception(e)
+  return found.result()
+
+def forget_sources():
+  # before every build, sources may have been added or removed since the last one
+  with _sources_lock: _sources.clear()
+
+def batch_limit(target : Target) -> int:
+  # batch: true | <max files per compiler invocation>
+  batch = target.get("batch", False)
+  return 1 if not batch else Compiler.BATCH_SIZE if batch is True else int(batch)
+
 class Compiler(abc.ABC):
   instances : dict[type, Self] = {}
+  _modules : list[str] = []
   arch = ""
+  BATCH_SIZE = 16
+  # backend modules per target type, the first valid one wins
+  BACKENDS : dict[str, list[str]] = {
+    "c" : (["cbuild.tools.msvc"] if sys.platform == "win32" else []) + ["cbuild.tools.gcc"],
+    "c++" : (["cbuild.tools.msvc"] if sys.platform == "win32" else []) + ["cbuild.tools.gcc"],
+    "cmake" : ["cbuild.tools.cmake"],
+  }
+
   def __init__(self, target=list[str]) -> None: 
     self._target = target 
     self.is_valid = False
 
   @staticmethod
-  def Init(): 
-    available = [clazz() for clazz in Compiler.__subclasses__()]
+  def Init(types : set[str] = None): 
+    # only the backends of target types that are actually used are imported and probed
+    types = types if types is not None else set(Compiler.BACKENDS)
+    modules = list(dict.fromkeys(module for type in types for module in Compiler.BACKENDS.get(type, [])))
+    if modules == Compiler._modules: return # already probed (build server, watch mode)
+    Compiler._modules = modules
+    for module in modules: importlib.import_module(module)
+
+    classes = sorted([clazz for clazz in Compiler.__subclasses__() if clazz.__module__ in modules], key=lambda clazz: modules.index(clazz.__module__))
+    available = [clazz() for clazz in classes]
     Compiler.instances = { type(compiler) : compiler for compiler in available if compiler.is_valid}
 
   @property
@@ -0,0 +1,186 @@
+import hashlib
+import os
+import secrets
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import traceback
+from contextlib import redirect_stderr, redirect_stdout
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Client, Connection, Listener
+from pathlib import Path
+
+# Optional build server (`cbuild --daemon` or $CBUILD_DAEMON=1). It holds the loaded project,
+# the activated toolchain, the dependency databases and the warm caches, `cbuild` itself only
+# connects to it over a unix socket (named pipe on windows), sends its arguments and prints the
+# streamed output. The server of a project is started on first use and exits when idle.
+#
+# Only the standard library is imported here, the client does not pay for loading cbuild.
+IDLE_TIMEOUT = float(os.environ.get("CBUILD_DAEMON_IDLE", 15 * 60))
+CONNECT_TIMEOUT = 10
+# a server started with another toolchain environment is replaced
+ENVIRONMENT = ("PATH", "CC", "CXX", "AR", "INCLUDE", "LIB", "LIBPATH")
+
+def enabled(argv : list[str]) -> bool:
+  if any(arg in ("watch", "serve", "worker", "-h", "--help") for arg in argv): return False
+  return "--daemon" in argv or os.environ.get("CBUILD_DAEMON", "") not in ("", "0")
+
+def _address(folder : Path) -> str:
+  name = "cbuild-" + hashlib.sha1(str(folder.resolve()).encode()).hexdigest()[:16]
+  if sys.platform == "win32": return rf"\\.\pipe\{name}"
+  return os.path.join(tempfile.gettempdir(), f"{name}-{os.getuid()}.sock")
+
+def _key_file(folder : Path) -> Path:
+  return folder / ".cbuild" / "daemon.key"
+
+def _environment() -> dict[str, str]:
+  return { key : value for key, value in os.environ.items() if key in ENVIRONMENT or (key.startswith("CBUILD_") and key != "CBUILD_DAEMON") }
+
+def _connect(folder : Path) -> Connection | None:
+  deadline, spawned = time.monotonic() + CONNECT_TIMEOUT, False
+  while time.monotonic() < deadline:
+    try:
+      with open(_key_file(folder), "rb") as fp: key = fp.read()
+      return Client(_address(folder), authkey=key)
+    except (OSError, EOFError, AuthenticationError):
+      if not spawned: _spawn(folder)
+      spawned = True
+      time.sleep(0.05)
+  return None
+
+def _spawn(folder : Path):
+  os.makedirs(folder / ".cbuild", exist_ok=True)
+  detach = { "creationflags" : subprocess.DETACHED_PROCESS | subprocess.CREATE_NEW_PROCESS_GROUP } if sys.platform == "win32" else { "start_new_session" : True }
+  with open(folder / ".cbuild" / "daemon.log", "ab") as log:
+    subprocess.Popen([sys.executable, "-m", "cbuild", "serve"], cwd=folder, stdin=subprocess.DEVNULL, stdout=log, stderr=log, **detach)
+
+def request(argv : list[str], folder : Path = Path(".")) -> int | None:
+  # returns the exit code of the build, None if no server could be reached
+  argv = [arg for arg in argv if arg != "--daemon"]
+  for _ in range(3):
+    connection = _connect(folder)
+    if connection is None: return None
+
+    with connection:
+      try:
+        connection.send({ "argv" : argv, "environment" : _environment() })
+        while True:
+          kind, payload = connection.recv()
+          if kind == "output":
+            sys.stdout.write(payload)
+            sys.stdout.flush()
+          elif kind == "exit": return payload
+          elif kind == "restart": break
+      except (EOFError, OSError): pass # the server was just shutting down, start a new one
+
+  return None
+
+class _Output:
+  # stdout / stderr of the server while it runs a build, written by all build threads
+  def __init__(self, connection : Connection) -> None:
+    self.connection = connection
+    self.lock = threading.Lock()
+
+  def write(self, text : str) -> int:
+    with self.lock: self.connection.send(("output", text))
+    return len(text)
+
+  def flush(self):
+    pass
+
+class BuildServer:
+  def __init__(self, folder : str = ".") -> None:
+    self.folder = Path(folder).resolve()
+    self.address = _address(self.folder)
+    self.environment = _environment()
+    self.project = None
+    self.stamps = None
+    self.watcher = None
+    self.busy = False
+    self.last_request = time.monotonic()
+
+  def serve(self):
+    try:
+      # there already is a server for this project
+      with open(_key_file(self.folder), "rb") as fp: Client(self.address, authkey=fp.read()).close()
+      return
+    except (OSError, EOFError, AuthenticationError): pass
+
+    # a left over socket of a crashed server
+    if sys.platform != "win32" and os.path.exists(self.address): os.remove(self.address)
+
+    key = secrets.token_bytes(32)
+    os.makedirs(self.folder / ".cbuild", exist_ok=True)
+    with os.fdopen(os.open(_key_file(self.folder), os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), "wb") as fp: fp.write(key)
+
+    listener = Listener(self.address, authkey=key)
+    threading.Thread(target=self._watchdog, name="cbuild-idle", daemon=True).start()
+    print(f"cbuild server of {self.folder} listening on {self.address}", flush=True)
+
+    while True:
+      try: connection = listener.accept()
+      except (OSError, EOFError, AuthenticationError): continue
+      with connection: self._handle(connection)
+
+  def _shutdown(self):
+    if sys.platform != "win32" and os.path.exists(self.address): os.remove(self.address)
+    os._exit(0)
+
+  def _watchdog(self):
+    while True:
+      time.sleep(min(IDLE_TIMEOUT, 5))
+      if not self.busy and time.monotonic() - self.last_request > IDLE_TIMEOUT: self._shutdown()
+
+  def _handle(self, connection : Connection):
+    self.busy = True
+    try:
+      request = connection.recv()
+      if request["environment"] != self.environment:
+        connection.send(("restart", None))
+        self._shutdown()
+
+      connection.send(("exit", self._build(request["argv"], connection)))
+    except (EOFError, OSError): pass # the client is gone (ctrl+c)
+    finally:
+      self.busy, self.last_request = False, time.monotonic()
+
+  def _load(self):
+    from cbuild.depdb import DependencyDatabase
+    from cbuild.graph import BuildGraph
+    from cbuild.project import Project
+    from cbuild.watch import Watcher
+
+    # the project is loaded again only if one of its files changed, only changed files are stat'ed again
+    if self.project is not None and self.project._stamps() == self.stamps:
+      DependencyDatabase.forget(self.watcher.pending(), self.watcher.folders, self.watcher.ignored)
+      return self.project
+
+    self.project = Project(self.folder)
+    self.stamps = self.project._stamps()
+    if self.watcher is not None: self.watcher.close()
+    self.watcher = Watcher.ForTargets(BuildGraph(self.project.get_start_target()).targets)
+    DependencyDatabase.forget()
+    return self.project
+
+  def _build(self, argv : list[str], connection : Connection) -> int:
+    from cbuild import cbuild
+    from cbuild.log import error
+
+    output = _Output(connection)
+    with redirect_stdout(output), redirect_stderr(output):
+      try:
+        start = time.monotonic()
+        args = cbuild.parse_args(argv)
+        cbuild.configure(args)
+
+        result = cbuild.build(self._load(), args.config)
+        if result.error(): error(result)
+
+        print("Execution took", time.monotonic() - start, "seconds")
+        return 0
+      except SystemExit as e: return e.code if isinstance(e.code, int) else 1
+      except Exception:
+        traceback.print_exc()
+        return 1
@@ -0,0 +1,95 @@
+import os
+from pathlib import Path
+from cbuild.cache import CacheFile
+from cbuild.util import fingerprint
+from cbuild import journal, trace
+
+# Per target record of every compiled translation unit, keyed by its source file.
+# An entry holds the command line of the object and a (size, mtime) fingerprint of
+# the source and of every header it included, so unchanged units can be skipped.
+# Link and archive steps are recorded the same way under the path of their output.
+class DependencyDatabase:
+  instances : dict[Path, "DependencyDatabase"] = {}
+
+  def __init__(self, file : Path) -> None:
+    self.cache = CacheFile(file)
+    self._stats : dict[str, list[int] | None] = {}
+
+  @staticmethod
+  def Get(file : Path) -> "DependencyDatabase":
+    # one database per target and process, watch mode keeps them (and their stat results) between builds
+    file = Path(file)
+    if file not in DependencyDatabase.instances: DependencyDatabase.instances[file] = DependencyDatabase(file)
+    return DependencyDatabase.instances[file]
+
+  @staticmethod
+  def forget(paths : set[Path] = None, folders : list[Path] = None, outputs : set[Path] = None):
+    # changed files are stat'ed again by the next build, without paths everything is. Files outside
+    # of the watched folders (system headers...) are never known to be unchanged, neither are the
+    # files cbuild generates itself below the output folders (unity sources, the auto pch header)
+    changed = { os.path.abspath(path) for path in paths } if paths is not None else None
+    watched = tuple(os.path.join(os.path.abspath(folder), "") for folder in folders) if folders is not None else None
+    generated = tuple(os.path.join(os.path.abspath(folder), "") for folder in outputs or [])
+    stale = lambda key: os.path.abspath(key) in changed or (watched is not None and not os.path.abspath(key).startswith(watched)) or (generated and os.path.abspath(key).startswith(generated))
+
+    for database in DependencyDatabase.instances.values():
+      if changed is None: database._stats.clear()
+      else:
+        for key in [key for key in database._stats if stale(key)]: del database._stats[key]
+
+  def _fingerprint(self, path : str) -> list[int] | None:
+    # the same headers are shared by most units of a target, stat each one only once
+    if path not in self._stats: self._stats[path] = fingerprint(path)
+    return self._stats[path]
+
+  def is_up_to_date(self, source : Path, obj : Path, command : str, extra_inputs : list[Path] = []) -> bool:
+    entry = self.cache[str(source)]
+    if entry is None or entry["command"] != command or entry["object"] != str(obj): return False
+
+    obj_stamp = fingerprint(obj)
+    if obj_stamp is None: return False
+
+    for path in extra_inputs:
+      if str(path) not in entry["inputs"]: return False
+
+    for path, stamp in entry["inputs"].items():
+      current = self._fingerprint(path)
+      if current is None or current != stamp or current[1] > obj_stamp[1]: return False
+
+    trace.instant("up to date", "cache", source=str(source))
+    journal.record(entry["inputs"] | { str(obj) : obj_stamp })
+    return True
+
+  def record(self, source : Path, obj : Path, command : str, dependencies : list[Path], started : int = None):
+    # an input saved after the compile started (time.time_ns()) may not be what the object was built
+    # from, it is recorded without a stamp so the next build compiles the unit again
+    inputs = [str(source)] + [str(dep) for dep in dependencies]
+    self._stats.update({ path : fingerprint(path) for path in inputs })
+    current = lambda stamp: stamp is not None and (started is None or stamp[1] < started)
+    entry = {
+      "object" : str(obj),
+      "command" : command,
+      "inputs" : { path : self._stats[path] if current(self._stats[path]) else None for path in inputs }
+    }
+    self.cache[str(source)] = entry
+    journal.record(entry["inputs"] | { str(obj) : fingerprint(obj) })
+
+  def is_linked(self, output : Path, command : str, inputs : list[Path]) -> bool:
+    # inputs are stat'ed again, objects and dependency libraries were just rebuilt in this run
+    entry = self.cache["link:" + str(output)]
+    if entry is None or entry["command"] != command or entry["output"] != fingerprint(output): return False
+    if list(entry["inputs"]) != [str(path) for path in inputs]: return False
+    if any(fingerprint(path) != stamp for path, stamp in entry["inputs"].items()): return False
+
+    trace.instant("up to date", "link", output=str(output))
+    journal.record(entry["inputs"] | { str(output) : entry["output"] })
+    return True
+
+  def record_link(self, output : Path, command : str, inputs : list[Path]):
+    entry = {
+      "command" : command,
+      "output" : fingerprint(output),
+      "inputs" : { str(path) : fingerprint(path) for path in inputs }
+    }
+    self.cache["link:" + str(output)] = entry
+    journal.record(entry["inputs"] | { str(output) : entry["output"] })
@@ -0,0 +1,201 @@
+import json
+import os
+import tempfile
+import threading
+import time
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Client, Connection, Listener
+from pathlib import Path
+from cbuild.log import log, panic, warn
+from cbuild.processes import Program
+
+# distcc like remote compilation. The coordinator preprocesses a unit locally and sends the
+# preprocessed source with the code generation flags to a worker (`cbuild worker`), which
+# compiles it with its own compiler and sends the object back. Connections are authenticated
+# with $CBUILD_WORKER_KEY, the same key has to be set on the coordinator and on all workers.
+# A worker only listens on localhost unless a host is given, messages are plain json and bytes
+# (never pickled) and only code generation flags are passed on to its compiler, so holding the
+# key does not let a coordinator load plugins, run wrappers or write files on the worker.
+DEFAULT_PORT = 3633
+DEFAULT_HOST = "127.0.0.1"
+ALLOWED_FLAGS = ("-O", "-g", "-std=", "-W", "-f", "-m", "-D", "-U")
+ALLOWED_SWITCHES = { "-c", "-w", "-pedantic", "-pedantic-errors", "-pthread" }
+# -Wl, -Wa, -Wp, hand options to other tools, the -f / -m ones load code or write files of their choosing
+DENIED_FLAGS = ("-Wl,", "-Wa,", "-Wp,", "-fplugin", "-fdump", "-fopt-info", "-fprofile", "-fsave-optimization-record", "-fcallgraph-info", "-mllvm")
+_versions : dict[str, str] = {}
+
+def compiler_version(program : Program) -> str:
+  # objects are only accepted from workers running the exact same compiler
+  if program.program not in _versions:
+    version, _, _ = program.run_static(["--version"]).wait()
+    machine, _, _ = program.run_static(["-dumpmachine"]).wait()
+    _versions[program.program] = (version.splitlines() or [""])[0] + " " + machine.strip()
+  return _versions[program.program]
+
+def _key() -> bytes:
+  key = os.environ.get("CBUILD_WORKER_KEY", "")
+  panic(key != "", "Remote compilation needs a shared $CBUILD_WORKER_KEY")
+  return key.encode()
+
+def _address(address : str) -> tuple[str, int]:
+  host, _, port = address.strip().rpartition(":")
+  return (host, int(port)) if host else (port, DEFAULT_PORT)
+
+def allowed(arg : str) -> bool:
+  return arg in ALLOWED_SWITCHES or (arg.startswith(ALLOWED_FLAGS) and not arg.startswith(DENIED_FLAGS))
+
+def _send(connection : Connection, *message, data : bytes = None):
+  # a json header, the object file follows as its own frame
+  connection.send_bytes(json.dumps([data is not None, *message]).encode())
+  if data is not None: connection.send_bytes(data)
+
+def _recv(connection : Connection) -> tuple[list, bytes | None]:
+  # a malformed message is handled like a closed connection
+  try: has_data, *message = json.loads(connection.recv_bytes())
+  except (ValueError, TypeError) as e: raise EOFError(f"malformed message ({e})")
+  return message, connection.recv_bytes() if has_data else None
+
+class RemoteWorker:
+  RETRY = 30 # seconds an unreachable worker is skipped
+
+  def __init__(self, address : tuple[str, int], key : bytes) -> None:
+    self.address = address
+    self.key = key
+    self.slots = 0
+    self.versions : dict[str, str] = {}
+    self.running = 0
+    self.down_until = 0
+    self._idle : list[Connection] = []
+    self._lock = threading.Lock()
+
+  def __str__(self) -> str:
+    return f"{self.address[0]}:{self.address[1]}"
+
+  def connect(self) -> Connection:
+    with self._lock:
+      if self._idle: return self._idle.pop()
+    return Client(self.address, authkey=self.key)
+
+  def release(self, connection : Connection):
+    with self._lock: self._idle.append(connection)
+
+  def hello(self) -> bool:
+    try:
+      connection = self.connect()
+      _send(connection, "hello")
+      (self.slots, self.versions), _ = _recv(connection)
+      self.release(connection)
+      return True
+    except (OSError, EOFError, AuthenticationError) as e:
+      self.failed(e)
+      return False
+
+  def failed(self, reason : Exception):
+    warn(f"Worker {self} failed ({reason}), compiling locally for the next {RemoteWorker.RETRY} seconds")
+    with self._lock:
+      for connection in self._idle: connection.close()
+      self._idle.clear()
+      self.down_until = time.monotonic() + RemoteWorker.RETRY
+
+class WorkerPool:
+  instance : "WorkerPool" = None
+  TIMEOUT = 600 # seconds to wait for a remote compile
+
+  def __init__(self, addresses : list[str], key : bytes) -> None:
+    self.workers = [RemoteWorker(_address(address), key) for address in addresses]
+    self._lock = threading.Lock()
+    for worker in self.workers:
+      if worker.hello(): log(f"Worker {worker} with {worker.slots} slots")
+
+  @staticmethod
+  def Init(workers : str = None) -> "WorkerPool":
+    # disabled unless workers are given on the command line or in $CBUILD_WORKERS (host:port,host:port)
+    workers = workers or os.environ.get("CBUILD_WORKERS", None)
+    WorkerPool.instance = WorkerPool([address for address in workers.split(",") if address.strip()], _key()) if workers else None
+    return WorkerPool.instance
+
+  def slots(self) -> int:
+    return sum(worker.slots for worker in self.workers if worker.down_until <= time.monotonic())
+
+  def _pick(self, language : str, version : str) -> RemoteWorker | None:
+    # the least busy worker with the same compiler and a free slot, otherwise the unit stays local
+    with self._lock:
+      now = time.monotonic()
+      workers = [worker for worker in self.workers if worker.down_until <= now and worker.versions.get(language) == version and worker.running < worker.slots]
+      if not workers: return None
+      worker = min(workers, key=lambda worker: worker.running / worker.slots)
+      worker.running += 1
+      return worker
+
+  def compile(self, language : str, version : str, args : list[str], name : str, preprocessed : str) -> tuple[RemoteWorker, int, bytes | None, str] | None:
+    # None if no worker could compile the unit, the caller compiles it locally then
+    worker = self._pick(language, version)
+    if worker is None: return None
+
+    try:
+      connection = worker.connect()
+      _send(connection, "compile", language, args, name, data=preprocessed.encode())
+      if not connection.poll(WorkerPool.TIMEOUT): raise TimeoutError("no answer")
+      (code, err), obj = _recv(connection)
+      worker.release(connection)
+      return worker, code, obj, err
+    except (OSError, EOFError, AuthenticationError) as e:
+      worker.failed(e)
+      return None
+    finally:
+      with self._lock: worker.running -= 1
+
+# `cbuild worker`: compiles preprocessed sources for coordinators, one thread per connection and
+# at most one compile per core at a time. Other machines only reach it with an explicit --host
+class CompileWorker:
+  def __init__(self, host : str = None) -> None:
+    from cbuild.tools.gcc import GCCCompiler
+
+    self.address = _address(host or f"{DEFAULT_HOST}:{DEFAULT_PORT}")
+    self.slots = os.cpu_count() or 1
+    self.compilers = {
+      "c" : Program(os.environ.get("CC", None) or GCCCompiler._find(["gcc", "clang", "cc"])),
+      "c++" : Program(os.environ.get("CXX", None) or GCCCompiler._find(["g++", "clang++", "c++"]))
+    }
+    self.versions = { language : compiler_version(compiler) for language, compiler in self.compilers.items() if compiler.is_valid() }
+    self._semaphore = threading.Semaphore(self.slots)
+
+  def serve(self):
+    listener = Listener(self.address, authkey=_key())
+    log(f"Worker listening on {self.address[0]}:{self.address[1]} with {self.slots} slots ({", ".join(self.versions.values())})")
+
+    while True:
+      try: connection = listener.accept()
+      except (OSError, EOFError, AuthenticationError) as e:
+        warn(f"Rejected connection ({e})")
+        continue
+      threading.Thread(target=self._handle, args=(connection,), daemon=True).start()
+
+  def _handle(self, connection : Connection):
+    with connection:
+      while True:
+        try:
+          request, data = _recv(connection)
+          if request[0] == "hello": _send(connection, self.slots, self.versions)
+          elif request[0] == "compile":
+            language, args, name = request[1:]
+            if rejected := [arg for arg in args if not isinstance(arg, str) or not allowed(arg)]:
+              warn(f"Rejected compile of {name} with {" ".join(map(str, rejected))}")
+              _send(connection, 1, f"the worker does not accept {" ".join(map(str, rejected))}")
+              continue
+            code, obj, err = self._compile(language, args, str(name), data.decode())
+            _send(connection, code, err, data=obj)
+          else: return
+        except (OSError, EOFError, ValueError, KeyError, IndexError, AttributeError): return
+
+  def _compile(self, language : str, args : list[str], name : str, preprocessed : str) -> tuple[int, bytes | None, str]:
+    with self._semaphore, tempfile.TemporaryDirectory(prefix="cbuild-worker-") as folder:
+      # the suffix tells the driver that the source is already preprocessed
+      source = Path(folder) / (Path(name).stem + (".ii" if language == "c++" else ".i"))
+      obj = source.with_suffix(".o")
+      with open(source, "w") as fp: fp.write(preprocessed)
+
+      _, err, code = self.compilers[language].run_static(args + ["-o", str(obj), str(source)], cwd=folder).wait()
+      if code: return code, None, err
+
+      with open(obj, "rb") as fp: return 0, fp.read(), err
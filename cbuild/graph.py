@@ -0,0 +1,63 @@
+from concurrent.futures import FIRST_COMPLETED, CancelledError, Future, ThreadPoolExecutor, wait
+from functools import reduce
+from typing import Callable
+from cbuild.compiler import CompileError, CompileResult
+from cbuild.log import panic
+from cbuild.project import Target
+from cbuild.scheduler import JobScheduler
+from cbuild import trace
+
+class BuildGraph:
+  def __init__(self, *roots : Target) -> None:
+    # one root per configuration, their targets share the job pool of a single build
+    self.roots = list(roots)
+    self.root = self.roots[-1]
+    self.targets : list[Target] = [] # dependencies always come before their dependents
+    self.results : dict[Target, CompileResult] = {} # of the last execute
+    for root in self.roots: self._collect(root, [])
+
+  def _collect(self, target : Target, stack : list[Target]):
+    panic(target not in stack, f"Circular dependency {" -> ".join([t.label for t in stack + [target]])}")
+    if target in self.targets: return # diamond, already visited through another parent
+
+    for child in target._dependencies: self._collect(child, stack + [target])
+    self.targets.append(target)
+
+  def inputs(self, target : Target, results : dict[Target, CompileResult]) -> CompileResult:
+    # merged in declaration order so the result does not depend on which dependency finished first
+    return reduce(lambda x, y: x + y, [results[child] for child in target._dependencies], CompileResult())
+
+  def _build(self, build : Callable[[Target, CompileResult], CompileResult], target : Target, inputs : CompileResult) -> CompileResult:
+    with trace.span(target.label, "target", depends=[child.label for child in target._dependencies]):
+      return build(target, inputs)
+
+  def execute(self, build : Callable[[Target, CompileResult], CompileResult], previous : dict[Target, CompileResult] = {}) -> CompileResult:
+    # targets known to be up to date (watch mode) keep their previous result and are not built again
+    results : dict[Target, CompileResult] = dict(previous)
+    running : dict[Future, Target] = {}
+    failed : list[Target] = []
+
+    with ThreadPoolExecutor(max_workers=len(self.targets), thread_name_prefix="cbuild-target") as pool:
+      while True:
+        # targets depending on a failed one are skipped, nothing new starts once the build was stopped
+        started = set(running.values())
+        if not JobScheduler.Get().cancelled:
+          for target in self.targets:
+            if target in results or target in started: continue
+            if all(child in results and child not in failed for child in target._dependencies):
+              running[pool.submit(self._build, build, target, self.inputs(target, results))] = target
+
+        if not running: break
+
+        done, _ = wait(running, return_when=FIRST_COMPLETED)
+        for future in done:
+          target = running.pop(future)
+          # a job of the target was dropped, the build was stopped (--fail-fast, watch mode)
+          try: results[target] = future.result()
+          except CancelledError: results[target] = CompileError()
+          if results[target].error(): failed.append(target)
+
+    self.results = results
+    # targets that only stopped with the build have nothing to report, otherwise the last root speaks for the build
+    if failed: return results[min(failed, key=lambda target: (not results[target].has_errors(), self.targets.index(target)))]
+    return results[self.root]
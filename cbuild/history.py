@@ -0,0 +1,128 @@
+import os
+import pickle
+import threading
+from pathlib import Path
+from cbuild.processes import ResourceUsage
+from cbuild.project import Target
+from cbuild.util import fingerprint
+
+# Durations of compiles and links across runs (.cbuild/history), smoothed so a single slow run
+# does not take over. The scheduler starts the jobs with the longest estimated way to the end
+# of the build first: their own duration, the link of their target and the longest chain of
+# dependent targets after it. Sources without history are estimated from their size.
+# The peak memory and cpu time of the processes of every job are kept too, the scheduler only
+# starts jobs while their estimated memory fits (see JobScheduler).
+class DurationHistory:
+  instance : "DurationHistory" = None
+  VERSION = 2
+  WEIGHT = 0.5 # of the newest measurement
+  RATE_WEIGHT = 0.1
+  DEFAULT_RATE = 1e-4 # seconds per source byte until the first compile was measured
+
+  def __init__(self, file : Path) -> None:
+    self.file = Path(file)
+    self.durations : dict[str, float] = {}
+    self.rate = DurationHistory.DEFAULT_RATE
+    self.peaks : dict[str, float] = {} # bytes
+    self.cpu : dict[str, float] = {}
+    self.typical : dict[str, float] = {} # peak of the jobs of a kind (compile, link) without history of their own
+    self._tails : dict[str, float] = {}
+    self._owners : dict[str, str] = {}
+    self._longest : dict[str, float] = {}
+    self._work, self._path = 0.0, 0.0
+    self._lock = threading.Lock()
+
+    try:
+      with open(self.file, "rb") as fp: data = pickle.load(fp)
+      if data.get("version", None) == DurationHistory.VERSION:
+        self.durations, self.rate = data["durations"], data["rate"]
+        self.peaks, self.cpu, self.typical = data["peaks"], data["cpu"], data["typical"]
+    except Exception: pass
+
+  @staticmethod
+  def Init(folder : Path = Path(".")) -> "DurationHistory":
+    file = Path(folder) / ".cbuild" / "history"
+    if DurationHistory.instance is None or DurationHistory.instance.file != file: DurationHistory.instance = DurationHistory(file)
+    return DurationHistory.instance
+
+  @staticmethod
+  def compile_keys(sources : list[Path], configuration : str = None) -> dict[str, int | None]:
+    suffix = f" ({configuration})" if configuration is not None else ""
+    return { f"compile:{source}{suffix}" : (fingerprint(source) or [None])[0] for source in sources }
+
+  @staticmethod
+  def link_keys(label : str) -> dict[str, int | None]:
+    # links, archives and cmake builds, the last step of a target (of a configuration)
+    return { f"link:{label}" : None }
+
+  @staticmethod
+  def _smooth(previous : float | None, value : float) -> float:
+    return value if previous is None else previous + DurationHistory.WEIGHT * (value - previous)
+
+  def estimate(self, key : str, size : int = None) -> float:
+    if key in self.durations: return self.durations[key]
+    return size * self.rate if size else 0.0
+
+  def memory(self, keys : dict[str, int | None]) -> int:
+    # bytes a job needs at most, the sources of a batch are compiled one after the other
+    return int(max((self.peaks.get(key, self.typical.get(key.split(":")[0], 0)) for key in keys), default=0))
+
+  def plan(self, targets : list[Target]):
+    # tail: the link of a target and the longest chain of compiles and links of the targets that
+    # wait for it, targets come before their dependents
+    dependents : dict[Target, list[Target]] = { target : [] for target in targets }
+    for target in targets:
+      for child in target._dependencies: dependents[child].append(target)
+
+    with self._lock:
+      self._tails, self._owners, self._longest = {}, {}, {}
+      self._work, self._path = 0.0, 0.0
+      for target in reversed(targets):
+        after = [self.estimate("target:" + other.label) + self._tails[other.label] for other in dependents[target]]
+        self._tails[target.label] = self.estimate("link:" + target.label) + max(after, default=0.0)
+
+  def priority(self, name : str, keys : dict[str, int | None], link : bool = False) -> float:
+    # of a job of the target, smaller runs first. keys map the history keys of the job to the size of their source
+    estimate = sum(self.estimate(key, size) for key, size in keys.items())
+    remaining = self._tails.get(name, estimate if link else 0.0) + (0.0 if link else estimate)
+    with self._lock:
+      self._owners.update({ key : name for key in keys })
+      self._work += estimate
+      self._path = max(self._path, remaining)
+    return -remaining
+
+  def record(self, keys : dict[str, int | None], seconds : float, usage : ResourceUsage = None):
+    # a batch is split evenly between its sources, each of them may have been its peak. Jobs
+    # that started no process (cache hits, remote compiles) leave the memory as it was
+    share = seconds / max(1, len(keys))
+    measured = usage is not None and usage.peak > 0
+    with self._lock:
+      for key, size in keys.items():
+        self.durations[key] = DurationHistory._smooth(self.durations.get(key, None), share)
+        if size: self.rate += DurationHistory.RATE_WEIGHT * (share / size - self.rate)
+        if measured:
+          kind = key.split(":")[0]
+          self.peaks[key] = DurationHistory._smooth(self.peaks.get(key, None), usage.peak)
+          self.cpu[key] = DurationHistory._smooth(self.cpu.get(key, None), usage.cpu / max(1, len(keys)))
+          self.typical[kind] = DurationHistory._smooth(self.typical.get(kind, None), usage.peak)
+        if key.startswith("compile:") and (owner := self._owners.get(key, None)) is not None:
+          self._longest[owner] = max(self._longest.get(owner, 0.0), share)
+
+  def predicted(self, jobs : int) -> float | None:
+    # the longest chain or all of the work spread over the job slots, None if nothing ran
+    if not self._work and not self._path: return None
+    return max(self._path, self._work / max(1, jobs))
+
+  def write(self):
+    with self._lock:
+      for name, longest in self._longest.items():
+        self.durations["target:" + name] = DurationHistory._smooth(self.durations.get("target:" + name, None), longest)
+      self._longest = {}
+      data = { "version" : DurationHistory.VERSION, "durations" : self.durations, "rate" : self.rate, "peaks" : self.peaks, "cpu" : self.cpu, "typical" : self.typical }
+
+    os.makedirs(self.file.parent, exist_ok=True)
+    with open(self.file.with_suffix(".tmp"), "wb") as fp: pickle.dump(data, fp, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(self.file.with_suffix(".tmp"), self.file)
+
+def priority(name : str, keys : dict[str, int | None], link : bool = False) -> float:
+  return DurationHistory.instance.priority(name, keys, link) if DurationHistory.instance is not None else 0
@@ -0,0 +1,104 @@
+import os
+import pickle
+import threading
+from pathlib import Path
+from cbuild.daemon import ENVIRONMENT
+from cbuild.util import fingerprint
+
+# Record of the last successful build: the (size, mtime) of every project file, every input and
+# output of the whole graph, the folders the source patterns were expanded in and the sources of
+# cbuild itself, together with the toolchain environment. The command lines are derived from
+# nothing else, so if none of them changed `cbuild` exits after a single stat pass, before the
+# toolchain is activated or the project is loaded.
+VERSION = 1
+CONFLICT = [-1, -1] # a file seen with two different stamps during one build never matches
+WILDCARDS = ("*", "?", "[")
+
+def _file(folder : Path) -> Path:
+  return Path(folder) / ".cbuild" / "journal"
+
+def _environment() -> dict[str, str | None]:
+  return { key : os.environ.get(key, None) for key in ENVIRONMENT }
+
+# taken when cbuild starts, before the toolchain activation adds to PATH, INCLUDE...
+_startup_environment = _environment()
+
+def enabled(argv : list[str]) -> bool:
+  # only plain builds of every configuration, a trace or the other commands need the full run
+  return not any(arg in ("watch", "serve", "worker", "-h", "--help") or arg.startswith(("--trace", "--config")) for arg in argv)
+
+def is_up_to_date(folder : Path = Path(".")) -> bool:
+  try:
+    with open(_file(folder), "rb") as fp: data = pickle.load(fp)
+  except Exception: return False
+
+  if data.get("version", None) != VERSION or data["environment"] != _startup_environment: return False
+  return all(fingerprint(path) == stamp for path, stamp in data["files"].items())
+
+def _walk(folder : Path, skip : set[str], exclude = {}) -> list[tuple[str, list[str]]]:
+  # hidden folders are skipped like glob does, build outputs change with every build
+  found = []
+  for root, folders, files in os.walk(folder):
+    folders[:] = [name for name in folders if not name.startswith(".") and name not in exclude and os.path.normpath(os.path.join(root, name)) not in skip]
+    found.append((root, [name for name in files if name not in exclude]))
+  return found
+
+def _pattern_folders(root : Path, pattern : str, skip : set[str]) -> list[str]:
+  # an added or removed source changes the mtime of its folder. Wildcards in the file name only
+  # depend on one folder, recursive ones on every folder below the first wildcard
+  parts = Path(pattern).parts
+  fixed = next((index for index, part in enumerate(parts) if any(char in part for char in WILDCARDS)), len(parts))
+  base = os.path.join(root, *parts[:fixed])
+
+  if fixed == len(parts): return [os.path.dirname(base)]
+  if fixed == len(parts) - 1 and "**" not in parts[-1]: return [base]
+  return [folder for folder, _ in _walk(base, skip)]
+
+class BuildJournal:
+  instance : "BuildJournal" = None
+
+  def __init__(self, folder : Path) -> None:
+    self.file = _file(folder)
+    self.files : dict[str, list[int] | None] = {}
+    self._lock = threading.Lock()
+
+  @staticmethod
+  def Init(folder : Path = Path(".")) -> "BuildJournal":
+    # the journal of the last build goes first, a failed or interrupted build leaves none behind
+    BuildJournal.instance = BuildJournal(folder)
+    try: os.remove(BuildJournal.instance.file)
+    except OSError: pass
+    return BuildJournal.instance
+
+  def add(self, stamps : dict[str, list[int] | None]):
+    with self._lock:
+      for path, stamp in stamps.items():
+        self.files[path] = stamp if self.files.get(path, stamp) == stamp else CONFLICT
+
+  def write(self, project_stamps : dict[str, list[int] | None]):
+    # a changed cbuild might derive other command lines from the same project
+    sources = Path(__file__).resolve().parent
+    self.add({ str(file) : fingerprint(file) for file in sources.glob("**/*.py") })
+    self.add(project_stamps)
+
+    data = { "version" : VERSION, "environment" : _startup_environment, "files" : self.files }
+    os.makedirs(self.file.parent, exist_ok=True)
+    with open(self.file.with_suffix(".tmp"), "wb") as fp: pickle.dump(data, fp, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(self.file.with_suffix(".tmp"), self.file)
+
+# called by the compilers and the dependency databases while building, nothing is recorded
+# outside of a full build (watch mode)
+def record(stamps : dict[str, list[int] | None]):
+  if BuildJournal.instance is not None: BuildJournal.instance.add(stamps)
+
+def record_sources(root : Path, patterns : list[str], outputs : Path):
+  # before the patterns are expanded, a file added in the meantime is found by the next build
+  if BuildJournal.instance is None: return
+  skip = { os.path.normpath(outputs) }
+  record({ folder : fingerprint(folder) for pattern in patterns for folder in _pattern_folders(root, pattern, skip) })
+
+def record_folder(folder : Path, outputs : Path, exclude = {}):
+  # everything below the folder, e.g. the sources of a cmake project
+  if BuildJournal.instance is None: return
+  for root, files in _walk(folder, { os.path.normpath(outputs) }, exclude):
+    record({ path : fingerprint(path) for path in [root] + [os.path.join(root, name) for name in files] })
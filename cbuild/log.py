@@ -19,8 +19,8 @@ def panic(cond : bool, msg : str):
   cprint(msg, tag="ERROR", color="white", tag_color="red")
   exit(1)
 
-def error(msg : str):
+def error(msg : str, fatal : bool = True):
   cprint(msg, tag="ERROR", color="white", tag_color="red")
-  exit(1)
+  if fatal: exit(1)
 
   
\ No newline at end of file
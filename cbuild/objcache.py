@@ -0,0 +1,121 @@
+import hashlib
+import os
+import shutil
+import threading
+import time
+from pathlib import Path
+from cbuild.cache import CacheFile
+from cbuild.processes import Program
+from cbuild import trace
+
+# Content addressed store of compiled objects shared by every target, checkout and branch on
+# this machine. Objects are keyed by the preprocessed source, the compile arguments that
+# change code generation and the identity of the compiler binary. The least recently used
+# objects are evicted once the cache grows over its size limit.
+class ObjectCache:
+  instance : "ObjectCache" = None
+  DEFAULT_SIZE = "5G"
+
+  def __init__(self, folder : Path, max_size : int) -> None:
+    self.folder = Path(folder)
+    self.max_size = max_size
+    self.index = CacheFile(self.folder / "index") # key -> [size, last use]
+    self.stats = CacheFile(self.folder / "stats")
+    self.hits = 0
+    self.misses = 0
+    self._lock = threading.Lock()
+    self._identities : dict[tuple[str, str], str] = {}
+    self._size = sum(entry[0] for entry in self.index.items().values())
+
+  @staticmethod
+  def parse_size(size : str) -> int:
+    units = { "K" : 1 << 10, "M" : 1 << 20, "G" : 1 << 30, "T" : 1 << 40 }
+    size = str(size).strip().upper().removesuffix("B")
+    if size and size[-1] in units: return int(float(size[:-1]) * units[size[-1]])
+    return int(size)
+
+  @staticmethod
+  def Init(folder : str = None, max_size : str = None) -> "ObjectCache":
+    # disabled unless a cache folder is given on the command line or in $CBUILD_CACHE_DIR
+    folder = folder or os.environ.get("CBUILD_CACHE_DIR", None)
+    max_size = max_size or os.environ.get("CBUILD_CACHE_SIZE", ObjectCache.DEFAULT_SIZE)
+    if not folder: ObjectCache.instance = None
+    elif ObjectCache.instance is None or ObjectCache.instance.folder != Path(folder):
+      ObjectCache.instance = ObjectCache(Path(folder), ObjectCache.parse_size(max_size))
+    else: ObjectCache.instance.max_size = ObjectCache.parse_size(max_size)
+    return ObjectCache.instance
+
+  def identity(self, compiler : Program) -> str:
+    # cl.exe of x86 and x64 only differ in the PATH they are found on
+    search = (compiler.env or os.environ).get("PATH", None)
+    if (compiler.program, search) not in self._identities:
+      path = shutil.which(compiler.program, path=search) or compiler.program
+      stat = os.stat(path)
+      self._identities[(compiler.program, search)] = f"{os.path.realpath(path)}:{stat.st_size}:{stat.st_mtime_ns}"
+    return self._identities[(compiler.program, search)]
+
+  def key(self, compiler : Program, args : list[str], preprocessed : str) -> str:
+    hash = hashlib.sha256()
+    hash.update(self.identity(compiler).encode())
+    hash.update("\0".join(args).encode())
+    hash.update(preprocessed.encode())
+    return hash.hexdigest()
+
+  def _file(self, key : str) -> Path:
+    return self.folder / key[:2] / key
+
+  def fetch(self, key : str, obj : Path) -> bool:
+    cached = self._file(key)
+    if key not in self.index or not os.path.isfile(cached):
+      with self._lock: self.misses += 1
+      trace.instant("miss", "cache", object=str(obj))
+      return False
+
+    # copied instead of linked, the object has to be newer than its inputs for the dependency database
+    os.makedirs(obj.parent, exist_ok=True)
+    shutil.copyfile(cached, obj.with_suffix(obj.suffix + ".tmp"))
+    os.replace(obj.with_suffix(obj.suffix + ".tmp"), obj)
+    self.index[key] = [os.path.getsize(cached), time.time_ns()]
+
+    with self._lock: self.hits += 1
+    trace.instant("hit", "cache", object=str(obj))
+    return True
+
+  def store(self, key : str, obj : Path):
+    cached = self._file(key)
+    os.makedirs(cached.parent, exist_ok=True)
+    temp = cached.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+    shutil.copyfile(obj, temp)
+    os.replace(temp, cached)
+
+    size = os.path.getsize(cached)
+    self.index[key] = [size, time.time_ns()]
+
+    with self._lock:
+      self._size += size
+      if self._size > self.max_size: self._evict()
+
+  def _evict(self):
+    # drop the least recently used objects until 90% of the limit is left
+    entries = sorted(self.index.items().items(), key=lambda item: item[1][1])
+    self._size = sum(entry[0] for _, entry in entries)
+
+    evicted = []
+    for key, (size, _) in entries:
+      if self._size <= self.max_size * 0.9: break
+      if os.path.isfile(self._file(key)): os.remove(self._file(key))
+      self._size -= size
+      evicted.append(key)
+
+    self.index.remove(evicted)
+
+  def flush(self) -> tuple[int, int]:
+    # counters of this run are added to the totals of all runs sharing the cache
+    with self._lock:
+      hits, misses = (self.stats["hits"] or 0) + self.hits, (self.stats["misses"] or 0) + self.misses
+      self.stats.update({ "hits" : hits, "misses" : misses })
+      self.hits, self.misses = 0, 0
+    return hits, misses
+
+  def __repr__(self) -> str:
+    return f"<ObjectCache {self.folder} {self._size / (1 << 20):.1f}/{self.max_size / (1 << 20):.0f} MiB hits={self.hits} misses={self.misses}>"
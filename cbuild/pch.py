@@ -0,0 +1,67 @@
+import os
+import re
+from pathlib import Path
+from typing import Any
+from cbuild.project import Target
+from cbuild.util import write_if_changed
+
+# Generated precompiled headers: the system headers (<...>) most sources of a target include
+# before their first line of code are collected into one header, which goes through the
+# regular pch path of the compilers like a hand written one.
+#
+#   precompiled_header: auto | { auto: true, threshold: 0.5 }
+#
+# threshold is the share of the sources that have to include a header, at least two always
+# do. The generated files keep their mtime while the chosen headers stay the same, so the
+# pch is only compiled again when that set changes.
+DEFAULT_THRESHOLD = 0.5
+HEADER_NAME = "cbuild_pch.h"
+
+INCLUDE = re.compile(r'^\s*#\s*include\s*([<"])([^>"]+)[>"]')
+PRAGMA_ONCE = re.compile(r'^\s*#\s*pragma\s+once\b')
+
+def leading_includes(file : Path) -> list[str]:
+  # the system includes before anything else, a define, a condition or code may change what they mean
+  includes, comment = [], False
+  try:
+    with open(file, "r", errors="replace") as fp:
+      for line in fp:
+        line = line.strip()
+        if comment:
+          comment = "*/" not in line
+          continue
+        if not line or line.startswith("//") or PRAGMA_ONCE.match(line): continue
+        if line.startswith("/*"):
+          comment = "*/" not in line[2:]
+          continue
+
+        match = INCLUDE.match(line)
+        if match is None: break
+        if match.group(1) == "<": includes.append(match.group(2))
+  except OSError: pass
+  return includes
+
+def common_includes(files : list[Path], threshold : float) -> list[str]:
+  counts : dict[str, int] = {}
+  for file in files:
+    for header in dict.fromkeys(leading_includes(file)): counts[header] = counts.get(header, 0) + 1
+
+  # in the order they are first included, the sources are sorted so that order is stable
+  needed = max(2, threshold * len(files))
+  return [header for header, count in counts.items() if count >= needed]
+
+def precompiled_header(target : Target, files : list[Path], folder : Path, extension : str) -> dict[str, Any] | None:
+  settings = target.get("precompiled_header", None)
+  if settings != "auto" and not (isinstance(settings, dict) and settings.get("auto", False)): return settings
+
+  threshold = float(settings.get("threshold", DEFAULT_THRESHOLD)) if isinstance(settings, dict) else DEFAULT_THRESHOLD
+  headers = common_includes(sorted((target.root / file for file in files), key=lambda file: file.as_posix()), threshold)
+  if not headers: return None
+
+  os.makedirs(folder, exist_ok=True)
+  header, source = folder / HEADER_NAME, folder / ("cbuild_pch" + extension)
+  write_if_changed(header, "".join(f"#include <{name}>\n" for name in headers))
+  write_if_changed(source, f"#include \"{HEADER_NAME}\"\n")
+
+  # absolute paths, target.root / path keeps them as they are
+  return { "header" : str(header), "source" : str(source), "force_include" : True }
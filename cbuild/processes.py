@@ -1,80 +1,326 @@
+import asyncio
+import atexit
 import os
+import signal
 import shutil
 import subprocess
+import sys
 import tempfile
-from typing import Any
+import threading
+from concurrent.futures import Future
+from pathlib import Path
+from typing import Callable
+from cbuild import CBUILD_USER_DIR
+
+# All child processes are started and read by one asyncio loop on a background thread. Output
+# is streamed through pipes into memory, so capturing the output of thousands of compiles
+# costs no temp files, and the caller threads only block on a future until the process exits.
+class ProcessEngine:
+  instance : "ProcessEngine" = None
+  TIMEOUT_CODE = -9
+  # CreateProcess is limited to 32767 characters, a single argument on linux to 128 KiB
+  COMMAND_LINE_LIMIT = 30000 if sys.platform == "win32" else 100000
+
+  def __init__(self, timeout : float = None) -> None:
+    self.timeout = timeout
+    self.cancelled = False
+    self._running : set[asyncio.subprocess.Process] = set() # only touched on the loop thread
+    self.loop = asyncio.new_event_loop()
+    threading.Thread(target=self.loop.run_forever, name="cbuild-processes", daemon=True).start()
+    atexit.register(lambda: [ProcessEngine._kill(process) for process in list(self._running)])
+
+  @staticmethod
+  def Init(timeout : float = None) -> "ProcessEngine":
+    # per process timeout in seconds (default: $CBUILD_TIMEOUT, no timeout if unset)
+    timeout = timeout or float(os.environ.get("CBUILD_TIMEOUT", 0)) or None
+    if ProcessEngine.instance is None: ProcessEngine.instance = ProcessEngine(timeout)
+    else: ProcessEngine.instance.timeout = timeout
+    return ProcessEngine.instance
+
+  @staticmethod
+  def Get() -> "ProcessEngine":
+    if ProcessEngine.instance is None: ProcessEngine.Init()
+    return ProcessEngine.instance
+
+  def start(self, cmd : list[str], cwd = None, merge_output = False, timeout : float = None, on_output : Callable[[str, str], None] = None, cleanup : Callable = None, env : dict[str, str] = None) -> tuple[Future, Future]:
+    # the future resolves to the started process, its result() to (stdout, stderr, code). The
+    # resources of the process are added to the usage measured by the calling thread (a job)
+    started = Future()
+    result = asyncio.run_coroutine_threadsafe(self._run(cmd, cwd, merge_output, timeout or self.timeout, on_output, started, ResourceUsage.current(), env), self.loop)
+    if cleanup is not None: result.add_done_callback(lambda _: cleanup())
+    return started, result
+
+  async def _run(self, cmd : list[str], cwd, merge_output : bool, timeout : float, on_output : Callable[[str, str], None], started : Future, usage : "ResourceUsage", env : dict[str, str]) -> tuple[str, str, int]:
+    try:
+      if sys.platform != "win32": process, exited, pipes = await self._spawn(cmd, cwd, merge_output, env)
+      else:
+        # env=None hands every child the environment of cbuild itself (with the activated toolchain)
+        # instead of building a copy of it for each process
+        process = await asyncio.create_subprocess_exec(*cmd, cwd=cwd, env=env, stdin=subprocess.DEVNULL,
+          stdout=subprocess.PIPE, stderr=subprocess.STDOUT if merge_output else subprocess.PIPE)
+        # the handle stays open as long as the Popen object lives, the usage is read after the exit
+        popen = process._transport.get_extra_info("subprocess")
+        exited, pipes = asyncio.ensure_future(process.wait()), { "stdout" : process.stdout, "stderr" : process.stderr }
+    except BaseException as e:
+      started.set_exception(e)
+      raise
+    started.set_result(process)
+    self._running.add(process)
+    if self.cancelled: ProcessEngine._kill(process)
+
+    streams = { "stdout" : [] } if merge_output else { "stdout" : [], "stderr" : [] }
+    readers = [self._read(pipes[name], name, chunks, on_output) for name, chunks in streams.items()]
+
+    timed_out = False
+    try: await asyncio.wait_for(asyncio.gather(*readers, asyncio.shield(exited)), timeout)
+    except TimeoutError:
+      timed_out = True
+      ProcessEngine._kill(process)
+      await exited
+    finally: self._running.discard(process)
+
+    if usage is not None:
+      if sys.platform != "win32": usage.add(*exited.result()[1])
+      else: usage.add(*_windows_usage(popen._handle))
+
+    decode = lambda chunks: b"".join(chunks).decode("utf-8", errors="replace").replace("\r\n", "\n")
+    stdout, stderr = decode(streams["stdout"]), decode(streams.get("stderr", []))
+    if timed_out:
+      stderr += f"{cmd[0]}: killed after {timeout} seconds\n"
+      return stdout, stderr, ProcessEngine.TIMEOUT_CODE
+
+    return stdout, stderr, process.returncode
+
+  async def _spawn(self, cmd : list[str], cwd, merge_output : bool, env : dict[str, str]) -> tuple[subprocess.Popen, asyncio.Future, dict[str, asyncio.StreamReader]]:
+    # asyncio reaps its processes with waitpid and drops their resource usage, so on posix the
+    # processes are waited for by a thread of their own (like the threaded child watcher of
+    # asyncio) with wait4, which also reports the peak memory of the children it waited for.
+    # Every process gets its own group, killing it also stops what it started (cc1plus, ld...)
+    process = subprocess.Popen(cmd, cwd=cwd, env=env, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+      stderr=subprocess.STDOUT if merge_output else subprocess.PIPE, process_group=0)
+    exited = self.loop.create_future()
+
+    def finish(code : int, usage : tuple[int, float]):
+      process.returncode = code
+      exited.set_result((code, usage))
+
+    def wait():
+      _, status, usage = os.wait4(process.pid, 0)
+      # kilobytes on linux, bytes on macos
+      peak = usage.ru_maxrss * (1 if sys.platform == "darwin" else 1 << 10)
+      self.loop.call_soon_threadsafe(finish, os.waitstatus_to_exitcode(status), (peak, usage.ru_utime + usage.ru_stime))
+    threading.Thread(target=wait, name=f"cbuild-wait-{process.pid}", daemon=True).start()
+
+    pipes = {}
+    for name in ("stdout", "stderr"):
+      if (pipe := getattr(process, name)) is None: continue
+      pipes[name] = asyncio.StreamReader()
+      await self.loop.connect_read_pipe(lambda reader=pipes[name]: asyncio.StreamReaderProtocol(reader), pipe)
+    return process, exited, pipes
+
+  async def _read(self, stream : asyncio.StreamReader, name : str, chunks : list[bytes], on_output : Callable[[str, str], None]):
+    # without a callback the output is only collected, lines are split only if someone listens
+    pending = b""
+    while chunk := await stream.read(1 << 16):
+      chunks.append(chunk)
+      if on_output is None: continue
+
+      *lines, pending = (pending + chunk).split(b"\n")
+      for line in lines: on_output(name, line.decode("utf-8", errors="replace").rstrip("\r") + "\n")
+
+    if on_output is not None and pending: on_output(name, pending.decode("utf-8", errors="replace"))
+
+  @staticmethod
+  def _kill(process : asyncio.subprocess.Process):
+    if process.returncode is not None: return
+    if sys.platform != "win32":
+      try: os.killpg(process.pid, signal.SIGKILL)
+      except OSError: pass
+    else: process.kill()
+
+  def kill(self, process : asyncio.subprocess.Process):
+    self.loop.call_soon_threadsafe(ProcessEngine._kill, process)
+
+  def cancel(self):
+    # kills every running process, processes started until resume() is called are killed right away
+    def cancel():
+      self.cancelled = True
+      for process in self._running: ProcessEngine._kill(process)
+    self.loop.call_soon_threadsafe(cancel)
+
+  def resume(self):
+    self.loop.call_soon_threadsafe(setattr, self, "cancelled", False)
+
+
+class ResourceUsage:
+  # peak memory (bytes) and cpu time (seconds) of the processes started by one thread while the
+  # usage is entered, the scheduler measures every job this way
+  _local = threading.local()
+
+  def __init__(self) -> None:
+    self.peak, self.cpu = 0, 0.0
+    self._lock = threading.Lock()
+
+  @staticmethod
+  def current() -> "ResourceUsage | None":
+    return getattr(ResourceUsage._local, "usage", None)
+
+  def add(self, peak : int, cpu : float):
+    # the processes of a job run one after the other, the largest one is its peak
+    with self._lock: self.peak, self.cpu = max(self.peak, peak), self.cpu + cpu
+
+  def __enter__(self) -> "ResourceUsage":
+    ResourceUsage._local.usage = self
+    return self
+
+  def __exit__(self, *_):
+    ResourceUsage._local.usage = None
+
+def _windows_usage(handle : int) -> tuple[int, float]:
+  # peak working set and user + kernel time of an exited process, cl.exe compiles in process
+  import ctypes
+  from ctypes import wintypes
+
+  class MemoryCounters(ctypes.Structure):
+    _fields_ = [("cb", wintypes.DWORD), ("PageFaultCount", wintypes.DWORD)] + [(name, ctypes.c_size_t) for name in ("PeakWorkingSetSize",
+      "WorkingSetSize", "QuotaPeakPagedPoolUsage", "QuotaPagedPoolUsage", "QuotaPeakNonPagedPoolUsage", "QuotaNonPagedPoolUsage", "PagefileUsage", "PeakPagefileUsage")]
+
+  counters, times = MemoryCounters(), [wintypes.FILETIME() for _ in range(4)]
+  counters.cb = ctypes.sizeof(MemoryCounters)
+  if not ctypes.windll.psapi.GetProcessMemoryInfo(wintypes.HANDLE(handle), ctypes.byref(counters), counters.cb): return 0, 0.0
+  if not ctypes.windll.kernel32.GetProcessTimes(wintypes.HANDLE(handle), *[ctypes.byref(time) for time in times]): return counters.PeakWorkingSetSize, 0.0
+  # creation, exit, kernel and user time in 100ns ticks
+  return counters.PeakWorkingSetSize, sum((time.dwHighDateTime << 32 | time.dwLowDateTime) / 1e7 for time in times[2:])
+
 
 class Program:
-  def __init__(self, program):
+  PROBE_CACHE = Path(CBUILD_USER_DIR) / "toolchain.ch"
+  _probes = None
+
+  def __init__(self, program, response_style : str = "gnu", env : dict[str, str] = None):
     self.program = program
+    self.response_style = response_style # quoting of response files, "gnu" or "msvc"
+    self.env = env # None runs the program with the environment of cbuild
 
   def is_valid(self) -> bool:
-    return shutil.which(self.program) or os.path.isfile(self.program)
-  
-  def run_static(self, args : str, cwd = None) -> "StaticProcess":
-    cmd = [self.program] + (args.split(" ") if args is not None else [])
-    stdout_file = tempfile.TemporaryFile()
-    stderr_file = tempfile.TemporaryFile()
-    link = subprocess.Popen(cmd, stdout=stdout_file, stderr=stderr_file, stdin=subprocess.DEVNULL, env=os.environ.copy(), universal_newlines=True, cwd=cwd)
-    return StaticProcess(self, link, stdout_file, stderr_file)
-  
-  def run_dynamic(self, args : str, cwd = None) -> "DynamicProcess":
-    cmd = [self.program] + (args.split(" ") if args is not None else [])
-    link = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, stdin=subprocess.DEVNULL, env=os.environ.copy(), universal_newlines=True, cwd=cwd)
-    return DynamicProcess(self, link)
+    return self.resolve() is not None
+
+  def resolve(self) -> str | None:
+    # searching the PATH is remembered across runs, a cached result stays valid as long as
+    # the PATH is the same and the binary it points to was not replaced
+    import sqlite3
+    from cbuild.cache import CacheFile
+    from cbuild.util import fingerprint
+
+    if os.path.isfile(self.program): return str(self.program)
+    search = (self.env or os.environ).get("PATH", "")
+    if Program._probes is None:
+      # without a writable cache folder the PATH is searched on every run
+      try: Program._probes = CacheFile(Program.PROBE_CACHE)
+      except (OSError, sqlite3.Error): Program._probes = False
+    if Program._probes is False: return shutil.which(self.program, path=search or None)
+
+    key = f"{self.program}|{search}"
+    if (entry := Program._probes[key]) is not None and fingerprint(entry[0]) == entry[1]: return entry[0]
+
+    path = shutil.which(self.program, path=search or None)
+    if path is not None:
+      try: Program._probes[key] = [path, fingerprint(path)]
+      except sqlite3.Error: pass # read only
+    return path
+
+  def _quote(self, arg : str) -> str:
+    if self.response_style == "msvc": return subprocess.list2cmdline([arg])
+    return "\"" + arg.replace("\\", "\\\\").replace("\"", "\\\"") + "\""
+
+  def _command(self, args : list[str] | str) -> tuple[list[str], Callable]:
+    # a plain string is still accepted for simple commands without paths
+    args = [str(arg) for arg in args] if not isinstance(args, str) else args.split(" ") if args else []
+    cmd = [str(self.program)] + args
+    if len(subprocess.list2cmdline(cmd)) <= ProcessEngine.COMMAND_LINE_LIMIT: return cmd, None
+
+    # too long for the os, the arguments are handed over in a response file instead
+    fd, response_file = tempfile.mkstemp(suffix=".rsp", text=True)
+    with os.fdopen(fd, "w") as fp: fp.write("\n".join(self._quote(arg) for arg in args))
+    return [str(self.program), "@" + response_file], lambda: os.remove(response_file)
+
+  def run_static(self, args : list[str] | str, cwd = None, merge_output = False, timeout : float = None, on_output : Callable[[str, str], None] = None) -> "StaticProcess":
+    # on_output sees every line while the process runs, the whole output is still returned by wait()
+    cmd, cleanup = self._command(args)
+    started, result = ProcessEngine.Get().start(cmd, cwd, merge_output, timeout, on_output, cleanup, self.env)
+    return StaticProcess(self, cmd, started, result)
+
+  def run_dynamic(self, args : list[str] | str, cwd = None, timeout : float = None) -> "DynamicProcess":
+    cmd, cleanup = self._command(args)
+    lines = DynamicProcess.Lines()
+    started, result = ProcessEngine.Get().start(cmd, cwd, False, timeout, on_output=lines.put, cleanup=cleanup, env=self.env)
+    result.add_done_callback(lambda _: lines.close())
+    return DynamicProcess(self, cmd, started, result, lines)
 
 
 class Process:
-  def __init__(self, program : Program, link : subprocess.Popen) -> None:
+  def __init__(self, program : Program, cmd : list[str], started : Future, result : Future) -> None:
     self.program = program
-    self.link = link
+    self.cmd = cmd
+    self.started = started
+    self.result = result
 
   def has_finished(self) -> bool:
-    return self.link.poll() is not None 
+    return self.result.done()
 
   def kill(self):
-    self.link.kill()
+    ProcessEngine.Get().kill(self.started.result())
 
   def return_code(self):
-    return self.link.returncode
-  
+    return self.result.result()[2] if self.result.done() else None
+
   def pid(self):
-    return self.link.pid
-  
+    return self.started.result().pid
+
   def args(self):
-    return self.link.args
+    return self.cmd
 
 class StaticProcess(Process):
-
-  def __init__(self, program: Program, link: subprocess.Popen, stdout: tempfile.TemporaryFile, stderr: tempfile.TemporaryFile) -> None:
-    super().__init__(program, link)
-    self.stdout : tempfile.TemporaryFile = stdout
-    self.stderr : tempfile.TemporaryFile = stderr
-
-  def wait(self) -> tuple[str, str]:
-    self.link.wait()
-    
-    self.stdout.seek(0)
-    self.stderr.seek(0)
-    
-    stdout = self.stdout.read().decode('utf-8') if self.stdout else ""
-    stderr = self.stderr.read().decode('utf-8') if self.stderr else ""
-    
-    self.stdout.close()
-    self.stderr.close()
-    return stdout, stderr, self.return_code()
+  def wait(self) -> tuple[str, str, int]:
+    return self.result.result()
 
 class DynamicProcess(Process):
-  def __init__(self, program: Program, link: subprocess.Popen) -> None:
-    super().__init__(program, link)
-  
+  class Lines:
+    # lines of both streams in the order they arrived, closed once the process exited
+    def __init__(self) -> None:
+      self.lines : list[tuple[str, str]] = []
+      self.closed = False
+      self.condition = threading.Condition()
+
+    def put(self, stream : str, line : str):
+      with self.condition:
+        self.lines.append((stream, line))
+        self.condition.notify_all()
+
+    def close(self):
+      with self.condition:
+        self.closed = True
+        self.condition.notify_all()
+
+    def read(self, stream : str):
+      index = 0
+      while True:
+        with self.condition:
+          while index >= len(self.lines) and not self.closed: self.condition.wait()
+          if index >= len(self.lines): return
+          name, line = self.lines[index]
+          index += 1
+        if name == stream: yield line
+
+  def __init__(self, program : Program, cmd : list[str], started : Future, result : Future, lines : "DynamicProcess.Lines") -> None:
+    super().__init__(program, cmd, started, result)
+    self.lines = lines
+
   def output(self):
-    for stdout_line in iter(self.link.stdout.readline, ""):
-      yield stdout_line
-    
+    yield from self.lines.read("stdout")
+
   def error(self):
-    for stdout_line in iter(self.link.stderr.readline, ""):
-      yield stdout_line
+    yield from self.lines.read("stderr")
 
   def wait(self) -> int:
-    return self.link.wait() 
\ No newline at end of file
+    return self.result.result()[2]
@@ -1,12 +1,24 @@
 from functools import reduce
 import os
+import pickle
 from pathlib import Path
 from dataclasses import dataclass
 from typing import Any, Self
-import yaml
 
 
 from cbuild.log import warn, log, panic
+from cbuild.util import fingerprint
+
+def merge_settings(base : dict[str, Any], overrides : dict[str, Any]) -> dict[str, Any]:
+  # lists are extended, dicts merged and everything else replaced, a setting of another kind
+  # (the dict defines of cmake next to the list of a configuration) is kept as it is
+  merged = dict(base)
+  for key, value in overrides.items():
+    current = merged.get(key, None)
+    if isinstance(value, list) and isinstance(current, (list, str)): merged[key] = ([current] if isinstance(current, str) else current) + value
+    elif isinstance(value, dict) and isinstance(current, dict): merged[key] = { **current, **value }
+    elif current is None or (not isinstance(current, (list, dict)) and not isinstance(value, (list, dict))): merged[key] = value
+  return merged
 
 class Target:
 
@@ -16,6 +28,8 @@ class Target:
     self.type : str = type
     self._data : dict[str, str] = data
     self._dependencies : list[Target] = []
+    self.configuration : str | None = None
+    self._configuration_dir = ""
 
   def add_dependency(self, target : Self):
     self._dependencies += [target]
@@ -23,6 +37,28 @@ class Target:
   def file(self):
     return self.root / "project.yaml"
 
+  @property
+  def label(self) -> str:
+    # the name with the configuration, targets of different configurations share their name
+    return self.name if self.configuration is None else f"{self.name} ({self.configuration})"
+
+  def get_output_dir(self) -> Path:
+    # everything built for the target (of any configuration) ends up below this folder
+    return self.root / self.get("bin_dir", "bin/")
+
+  def get_bin_dir(self) -> Path:
+    return self.get_output_dir() / self._configuration_dir / self.name
+
+  def configure(self, name : str, settings : dict[str, Any], clones : dict[tuple[Self, str], Self]) -> Self:
+    # a copy of the target and its dependencies with the settings of a configuration merged in,
+    # every target is copied once per configuration
+    if (self, name) in clones: return clones[(self, name)]
+    clone = Target(self.root, self.name, self.type, merge_settings(self._data, { key : value for key, value in settings.items() if key != "bin_dir" }))
+    clone.configuration, clone._configuration_dir = name, settings.get("bin_dir", name)
+    clones[(self, name)] = clone
+    for dependency in self._dependencies: clone.add_dependency(dependency.configure(name, settings, clones))
+    return clone
+
   def get_dependency_list(self):
     if len(self._dependencies) == 0: return [self]
     return reduce(lambda x, y: x + y, [c.get_dependency_list() for c in self._dependencies], [self])
@@ -35,6 +71,8 @@ class Target:
     return f"<{self.name} of type {self.type} at {self.root}>"
 
 class Project:
+  SNAPSHOT_VERSION = 2
+
   def __init__(self, path : str = "."):
     self._files : dict[Path, Any] = {}
     self._settings : dict[str, Any] = {}
@@ -43,11 +81,46 @@ class Project:
 
     panic(os.path.isfile(Path(path) / "project.yaml"), "Nothing found")
 
+    # the resolved project is pickled, yaml is only imported and parsed if a project file changed
+    snapshot = Path(path) / ".cbuild" / "project.snapshot"
+    if self._load_snapshot(snapshot): return
+
     self._load(Path(path))
     self._resolve_dependencies()
+    self._save_snapshot(snapshot)
+
+  def _stamps(self) -> dict[str, list[int]]:
+    return { str(path / "project.yaml") : fingerprint(path / "project.yaml") for path in self._files }
+
+  def _load_snapshot(self, snapshot : Path) -> bool:
+    try:
+      with open(snapshot, "rb") as fp: data = pickle.load(fp)
+    except Exception: return False
+
+    if data.get("version", None) != Project.SNAPSHOT_VERSION: return False
+    if any(fingerprint(file) != stamp for file, stamp in data["stamps"].items()): return False
+
+    self._files, self._settings, self._targets, self._variables = data["files"], data["settings"], data["targets"], data["variables"]
+    return True
+
+  def _save_snapshot(self, snapshot : Path):
+    data = {
+      "version" : Project.SNAPSHOT_VERSION,
+      "stamps" : self._stamps(),
+      "files" : self._files,
+      "settings" : self._settings,
+      "targets" : self._targets,
+      "variables" : self._variables
+    }
+
+    os.makedirs(snapshot.parent, exist_ok=True)
+    with open(snapshot.with_suffix(".tmp"), "wb") as fp: pickle.dump(data, fp, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(snapshot.with_suffix(".tmp"), snapshot)
 
 
   def _load(self, path : Path):
+    import yaml
+
     path = path.resolve()
     if path in self._files: return # ciruclar 
     
@@ -107,6 +180,28 @@ class Project:
     panic(f"{name}" in self._targets.keys(), f"Specified start project {name} not specified")
     return self._targets[name]
 
+  def get_configurations(self) -> dict[str, dict[str, Any]]:
+    # configurations: { debug: { defines: [DEBUG] }, release: { flags: [-O2] } } or a list of such
+    # axes that are crossed, [{ debug: ..., release: ... }, { x64: ..., x86: ... }] gives debug-x64,
+    # debug-x86, release-x64 and release-x86
+    settings = self._settings.get("configurations", None)
+    if not settings: return {}
+
+    configurations = { "" : {} }
+    for axis in settings if isinstance(settings, list) else [settings]:
+      configurations = { f"{name}-{option}" if name else str(option) : merge_settings(base, values or {}) for name, base in configurations.items() for option, values in axis.items() }
+    return configurations
+
+  def get_start_targets(self, names : list[str] = None) -> list[Target]:
+    # the start target once per configuration (all of them by default), or as it is without configurations
+    target, configurations = self.get_start_target(), self.get_configurations()
+    if not configurations:
+      panic(not names, "There are no configurations declared")
+      return [target]
+
+    for name in names or []: panic(name in configurations, f"Unknown configuration {name} ({", ".join(configurations)})")
+    clones = {}
+    return [target.configure(name, configurations[name], clones) for name in names or configurations]
 
 
   def __repr__(self) -> str:
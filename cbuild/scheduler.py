@@ -0,0 +1,192 @@
+import heapq
+import itertools
+import os
+import sys
+import threading
+import time
+from concurrent.futures import Future
+from typing import Any, Callable
+from cbuild.history import DurationHistory
+from cbuild.log import warn
+from cbuild.processes import ProcessEngine, Program, ResourceUsage
+from cbuild import trace
+
+# One job pool shared by every target of a build. Each worker thread is a slot that runs
+# at most one external process at a time and blocks on it until it exits, so there are
+# never more than `jobs` compilers, linkers... running at once. Jobs with history also only
+# start while the peak memory recorded for them fits into the memory budget next to the
+# jobs already running, a job that does not fit lets smaller ones behind it go first.
+# A job running a build of its own (cmake --build) asks for several slots, it gets as many of
+# them as are free when it starts and keeps them until it is done, the memory recorded for it
+# (the peak of one of its processes) is reserved once for every slot.
+class JobScheduler:
+  instance : "JobScheduler" = None
+
+  def __init__(self, jobs : int, max_failures : int = None, memory : int = None) -> None:
+    self.jobs = max(1, jobs)
+    self.max_failures = max_failures # --fail-fast / --keep-going N, None builds whatever can be built
+    self.memory = memory # --memory-budget, None is the memory available when the build starts
+    self.budget : int | None = None
+    self.failures = 0
+    self._reserved = 0 # estimated bytes of the running jobs
+    self._busy = 0 # slots taken by the running jobs
+    self._queue : list[tuple[float, int, Future, Callable, tuple, dict, int, int | None]] = []
+    self._order = itertools.count()
+    self._condition = threading.Condition()
+    self._cancelled = False
+    self._threads : dict[int, threading.Thread] = {}
+    self.resize(self.jobs)
+
+  @staticmethod
+  def default_jobs() -> int:
+    return int(os.environ.get("CBUILD_JOBS", 0)) or os.cpu_count() or 1
+
+  @staticmethod
+  def available_memory() -> int | None:
+    # bytes the os can hand out without swapping, None where unknown
+    try:
+      if sys.platform == "win32":
+        import ctypes
+        class MemoryStatus(ctypes.Structure):
+          _fields_ = [("dwLength", ctypes.c_ulong), ("dwMemoryLoad", ctypes.c_ulong)] + [(name, ctypes.c_ulonglong) for name in ("ullTotalPhys",
+            "ullAvailPhys", "ullTotalPageFile", "ullAvailPageFile", "ullTotalVirtual", "ullAvailVirtual", "ullAvailExtendedVirtual")]
+        status = MemoryStatus()
+        status.dwLength = ctypes.sizeof(MemoryStatus)
+        return status.ullAvailPhys if ctypes.windll.kernel32.GlobalMemoryStatusEx(ctypes.byref(status)) else None
+      if sys.platform == "linux":
+        # MemFree leaves out the page cache the kernel gives up when needed
+        with open("/proc/meminfo", "r") as fp: return next(int(line.split()[1]) << 10 for line in fp if line.startswith("MemAvailable:"))
+      return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, StopIteration, AttributeError): return None
+
+  @staticmethod
+  def Init(jobs : int = None, max_failures : int = None, memory : int = None) -> "JobScheduler":
+    # the build server keeps its worker threads, another number of jobs only adds or removes some
+    jobs = max(1, jobs or JobScheduler.default_jobs())
+    if JobScheduler.instance is None: JobScheduler.instance = JobScheduler(jobs)
+    else: JobScheduler.instance.resize(jobs)
+    # a build stopped early (--fail-fast) does not stop the next one
+    JobScheduler.instance.max_failures = max_failures
+    JobScheduler.instance.memory = memory
+    JobScheduler.instance.resume()
+    return JobScheduler.instance
+
+  @staticmethod
+  def Get() -> "JobScheduler":
+    if JobScheduler.instance is None: JobScheduler.Init()
+    return JobScheduler.instance
+
+  def resize(self, jobs : int):
+    # missing slots get a thread, the threads of slots past the new number exit once their job is done
+    with self._condition:
+      self.jobs = max(1, jobs)
+      for slot in range(self.jobs):
+        if slot not in self._threads:
+          self._threads[slot] = threading.Thread(target=self._work, args=(slot,), name=f"cbuild-job-{slot}", daemon=True)
+          self._threads[slot].start()
+      self._condition.notify_all()
+
+  def submit(self, fn : Callable, *args : Any, priority : float = 0, keys : dict[str, int | None] = None, slots : int = None) -> Future:
+    # smaller priorities run first, the duration and memory of a job with history keys are recorded.
+    # A job asking for slots gets the number of slots it was given as its last argument
+    future = Future()
+    memory = DurationHistory.instance.memory(keys) if keys and DurationHistory.instance is not None else 0
+    with self._condition:
+      if self._cancelled: return JobScheduler._drop(future)
+      heapq.heappush(self._queue, (priority, next(self._order), future, fn, args, keys, memory, slots))
+      self._condition.notify()
+    return future
+
+  def run(self, program : Program, args : list[str], cwd = None, priority : float = 0, name : str = None, category : str = "job", keys : dict[str, int | None] = None) -> Future:
+    def job():
+      with trace.span(name or str(program.program), category) as event:
+        process = program.run_static(args, cwd)
+        event["pid"] = process.pid()
+        return process.wait()
+
+    return self.submit(job, priority=priority, keys=keys)
+
+  @property
+  def cancelled(self) -> bool:
+    return self._cancelled
+
+  def failed(self):
+    # a compile failed, once max_failures did the build stops like a cancelled one
+    with self._condition:
+      self.failures += 1
+      stop = self.failures == self.max_failures
+    if stop:
+      warn(f"Stopping the build after {self.failures} failed job{"s" if self.failures > 1 else ""}")
+      self.cancel()
+
+  def cancel(self):
+    # abandons the current build (watch mode, --fail-fast), queued jobs are dropped and running processes killed
+    with self._condition:
+      self._cancelled = True
+      queue, self._queue = self._queue, []
+    for _, _, future, *_ in queue: JobScheduler._drop(future)
+    ProcessEngine.Get().cancel()
+
+  @staticmethod
+  def _drop(future : Future) -> Future:
+    # as_completed() and wait() only see a cancelled future once it was also notified
+    future.cancel()
+    future.set_running_or_notify_cancel()
+    return future
+
+  def resume(self):
+    # the memory available is taken again for every build
+    budget = self.memory or JobScheduler.available_memory()
+    with self._condition: self._cancelled, self.failures, self.budget = False, 0, budget
+    ProcessEngine.Get().resume()
+
+  def _granted(self, job : tuple) -> int:
+    # slots a job would get now, each of them runs a process with the memory recorded for the
+    # job. With nothing else reserved any job gets a slot so one larger than the whole budget still runs (alone)
+    slots = min(job[7] or 1, self.jobs - self._busy)
+    if self.budget is None or not job[6]: return slots
+    fits = min(slots, (self.budget - self._reserved) // job[6])
+    return fits if self._reserved else max(1, fits)
+
+  def _admit(self) -> tuple[tuple, int] | None:
+    # the first job that fits into the free slots and the budget
+    if not self._queue or self._busy >= self.jobs: return None
+    if (slots := self._granted(self._queue[0])) > 0: job = heapq.heappop(self._queue)
+    else:
+      index = min((index for index, job in enumerate(self._queue) if self._granted(job) > 0), key=lambda index: self._queue[index][:2], default=None)
+      if index is None: return None
+      job, slots = self._queue[index], self._granted(self._queue[index])
+      self._queue[index] = self._queue[-1]
+      self._queue.pop()
+      heapq.heapify(self._queue)
+    self._reserved += job[6] * slots
+    self._busy += slots
+    return job, slots
+
+  def _release(self, memory : int, slots : int):
+    with self._condition:
+      self._reserved -= memory * slots
+      self._busy -= slots
+      self._condition.notify_all()
+
+  def _work(self, slot : int):
+    trace.set_slot(slot)
+    while True:
+      with self._condition:
+        while slot < self.jobs and (admitted := self._admit()) is None: self._condition.wait()
+        if slot >= self.jobs:
+          del self._threads[slot]
+          return
+      (_, _, future, fn, args, keys, memory, wanted), slots = admitted
+
+      if not future.set_running_or_notify_cancel():
+        self._release(memory, slots)
+        continue
+
+      usage, start = ResourceUsage(), time.monotonic()
+      try:
+        with usage: future.set_result(fn(*args, slots) if wanted else fn(*args))
+      except BaseException as e: future.set_exception(e)
+      finally: self._release(memory, slots)
+      # killed jobs of a stopped build say nothing about how long they take or how much memory they need
+      if keys and not self._cancelled and DurationHistory.instance is not None: DurationHistory.instance.record(keys, time.monotonic() - start, usage)
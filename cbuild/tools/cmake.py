@@ -1,13 +1,17 @@
 import abc
 import os
 from pathlib import Path
+import re
 import shutil
 from cbuild.compiler import Compiler, CompileResult, LibCompileResult, CompileError
 from cbuild.project import Target
 from cbuild.processes import Program
+from cbuild.scheduler import JobScheduler
 from cbuild.log import log, success, panic
 from cbuild.cache import CacheFile
-from cbuild.util import hash_folder
+from cbuild.history import DurationHistory
+from cbuild.util import fingerprint, hash_folder
+from cbuild import history, journal, trace
 
 class CMakeCompiler(Compiler):
   NAME="CMAKE"
@@ -21,50 +25,93 @@ class CMakeCompiler(Compiler):
 
   def __call__(self, target : Target, res : CompileResult) -> CompileResult:
 
-    bin_dir = target.root / target.get("bin_dir", "bin/") / target.name 
+    bin_dir = target.get_bin_dir()
     folder = target.root / target.get("folder", "")
     includes = target.get("includes", [])
     defines = [f"-D{key}={value}" for key, value in target.get("defines", {}).items()]
+    generator = target.get("generator", None)
     
     includes = includes if isinstance(includes, list) else [includes]    
     includes = [target.root / include for include in includes]
 
     cache = CacheFile(bin_dir / "cbuild.cache")
 
-    hash_value = hash_folder(folder, exclude={".cache"})
-
-    if hash_value in cache: 
-      success(CMakeCompiler.NAME + " cached " + target.name)
-      return LibCompileResult(**cache[hash_value])
-
-    success(CMakeCompiler.NAME + " creating build files " + target.name)
-    shutil.rmtree(bin_dir)
-    process = self.compiler.run_dynamic(f"{" ".join(defines)} -B {bin_dir} -S {folder}")
-
-    for message in process.output():
-      print(message, end="") 
-
-    return_code = process.wait()
-    panic(return_code == 0, CMakeCompiler.NAME + " failed on " + target.name)
-
-
-
-    success(CMakeCompiler.NAME + " building " + target.name)
-    process = self.compiler.run_dynamic(f"--build {bin_dir}")
-
-    static_lib = None
-    for message in process.output():
-      print(message, end="")
-      if "->" in message and message.endswith(".lib\n"): 
-        static_lib = message.split("-> ")[1].replace("\n", "")
+    journal.record_folder(folder, target.get_output_dir(), exclude={".cache"})
+    hash_value = hash_folder(folder, exclude={".cache"}, index=CacheFile(bin_dir / "cbuild.files"))
+
+    # unchanged sources only skip the build while cmake was also configured with the same defines and generator
+    configuration = { "defines" : defines, "generator" : generator }
+    if hash_value in cache and cache["configuration"] == configuration and os.path.isfile(bin_dir / "CMakeCache.txt"):
+      success(CMakeCompiler.NAME + " cached " + target.label)
+      result = LibCompileResult(**cache[hash_value])
+      journal.record({ str(lib) : fingerprint(lib) for lib in result.static_lib })
+      return result
+
+    # the build tree is reused, changes to the CMakeLists are picked up by cmake --build itself
+    if cache["configuration"] != configuration or not os.path.isfile(bin_dir / "CMakeCache.txt"):
+      # cmake refuses to switch the generator of an existing build tree
+      if cache["configuration"] is not None and cache["configuration"]["generator"] != generator:
+        shutil.rmtree(bin_dir / "CMakeFiles", ignore_errors=True)
+        if os.path.isfile(bin_dir / "CMakeCache.txt"): os.remove(bin_dir / "CMakeCache.txt")
+
+      success(CMakeCompiler.NAME + " creating build files " + target.label)
+      generator_args = ["-G", generator] if generator else []
+      with trace.span(f"configure {target.label}", "cmake") as event:
+        process = self.compiler.run_dynamic(generator_args + defines + ["-B", str(bin_dir), "-S", str(folder)])
+        event["pid"] = process.pid()
+
+        for message in process.output():
+          print(message, end="") 
+
+        return_code = process.wait()
+      panic(return_code == 0, CMakeCompiler.NAME + " failed on " + target.label)
+      cache["configuration"] = configuration
+
+
+    success(CMakeCompiler.NAME + " building " + target.label)
+    keys = DurationHistory.link_keys(target.label)
+    static_lib, return_code = JobScheduler.Get().submit(self._build, target, bin_dir, priority=history.priority(target.label, keys, link=True), keys=keys, slots=JobScheduler.Get().jobs).result()
+
+    if return_code:
+      errors = CompileError()
+      errors.add_error(folder, 0, "cmake --build failed", str(return_code))
+      return errors
+
+    if target.get("static_lib", None):
+      static_lib = str(bin_dir / target.get("static_lib", None))
+    elif static_lib:
+      cache["static_lib"] = static_lib
+    else:
+      # nothing was linked this time, the library of the last build is still up to date
+      static_lib = cache["static_lib"]
 
     if not static_lib:
-      return CompileError(folder, 0, "Failed to find a library to compile", 0)
+      errors = CompileError()
+      errors.add_error(folder, 0, "Failed to find a library to compile", "")
+      return errors
 
     cache[hash_value] = {
       "includes" : includes,
       "static_lib" : static_lib
     }
 
+    journal.record({ static_lib : fingerprint(static_lib) })
     success(CMakeCompiler.NAME + " compiled " + static_lib)
-    return LibCompileResult(includes, static_lib)
\ No newline at end of file
+    return LibCompileResult(includes, static_lib)
+
+  def _build(self, target : Target, bin_dir : Path, slots : int) -> tuple[str, int]:
+    # the sub-build runs as many compilers as the scheduler gave it slots
+    with trace.span(f"build {target.label}", "cmake") as event:
+      process = self.compiler.run_dynamic(["--build", str(bin_dir), "--parallel", str(slots)])
+      event["pid"] = process.pid()
+
+      static_lib = None
+      for message in process.output():
+        print(message, end="")
+        # msbuild: "name.vcxproj -> path/name.lib", ninja / make: "Linking CXX static library path/libname.a"
+        if "->" in message and message.endswith((".lib\n", ".a\n")): 
+          static_lib = message.split("-> ")[1].replace("\n", "")
+        elif match := re.search(r'static library (.+)$', message.strip()):
+          static_lib = str(bin_dir / match.group(1))
+
+      return static_lib, process.wait()
@@ -0,0 +1,292 @@
+from concurrent.futures import Future, as_completed
+from pathlib import Path
+from cbuild.compiler import CompileError, CompileErrorEntry, CompileResult, Compiler, Diagnostics, ExeCompileResult, HeaderCompileResult, LibCompileResult, batch_limit, compile_batches, find_sources
+from cbuild.depdb import DependencyDatabase
+from cbuild.distributed import WorkerPool, allowed, compiler_version
+from cbuild.history import DurationHistory
+from cbuild.log import success
+from cbuild.objcache import ObjectCache
+from cbuild.pch import precompiled_header
+from cbuild.processes import ProcessEngine, Program
+from cbuild.project import Target
+from cbuild.scheduler import JobScheduler
+from cbuild.unity import unity_sources
+from cbuild import history, trace
+import time
+import sys
+import os
+import re
+
+class GCCCompiler(Compiler):
+  NAME = "GCC"
+  LINE_MARKER = re.compile(r'^(# \d+ ")([^"]*)(".*)$', re.MULTILINE)
+  ERROR_PATTERN = re.compile(r'^(.+?):(\d+):(?:\d+:)?\s+(fatal error|error|warning):\s+(.+)$')
+
+  def __init__(self):
+    super().__init__(["c", "c++"])
+    self.cc = Program(os.environ.get("CC", None) or GCCCompiler._find(["gcc", "clang", "cc"]))
+    self.cxx = Program(os.environ.get("CXX", None) or GCCCompiler._find(["g++", "clang++", "c++"]))
+    self.ar = Program(os.environ.get("AR", None) or "ar")
+    self.is_valid = bool(self.cc.is_valid() and self.cxx.is_valid() and self.ar.is_valid())
+    self.is_clang = "clang" in Path(self.cxx.program).name
+
+  @staticmethod
+  def _find(programs : list[str]) -> str:
+    for program in programs:
+      if Program(program).is_valid(): return program
+    return programs[0]
+
+  def __call__(self, target : Target, res : LibCompileResult) -> CompileResult:
+    assert target.type in self.type
+    sources = target.get("sources", [])
+    include_paths = target.get("includes", [])
+    bin_dir = target.get_bin_dir()
+    kind = target.get("kind", None)
+    defines = target.get("defines", [])
+    flags = target.get("flags", [])
+
+    # sources and includes
+    sources = sources if isinstance(sources, list) else [sources]
+    include_paths = include_paths if isinstance(include_paths, list) else [include_paths]
+    include_paths = [target.root / i for i in include_paths] + res.includes
+
+    # if its a header lib we can return here
+    if kind == "header": return HeaderCompileResult(includes=include_paths)
+
+    compiler = self.cxx if target.type == "c++" else self.cc
+    language = "c++" if target.type == "c++" else "c"
+
+    # Compile arguments
+    defines = ["-D" + name for name in defines]
+    std_args = ["-c", "-g"]
+    include_args = ["-I" + str(include) for include in include_paths]
+    args = std_args + defines + (flags if isinstance(flags, list) else [flags]) + include_args
+
+    os.makedirs(bin_dir, exist_ok=True)
+
+    start = time.monotonic()
+    deps = DependencyDatabase.Get(bin_dir / "cbuild.deps")
+
+    src_files = find_sources(target, sources)
+
+    pch_inputs = []
+    if pch_data := precompiled_header(target, src_files, bin_dir / "pch", ".c" if target.type == "c" else ".cpp"):
+      # the header is compiled on its own and force included everywhere, the pch source is only needed by msvc
+      header = target.root / pch_data["header"]
+      pch_file = bin_dir / "pch" / (header.name + (".pch" if self.is_clang else ".gch"))
+
+      with trace.span(f"pch {target.label}", "pch", header=str(header)):
+        _, errors = self._compile_files(target, compiler, args + ["-x", f"{language}-header"], [(header, pch_file)], deps)
+      if errors.has_errors() or JobScheduler.Get().cancelled: return errors
+
+      pch_inputs = [pch_file]
+      args += ["-include-pch", str(pch_file)] if self.is_clang else ["-Winvalid-pch", "-include", str(pch_file.with_suffix(""))]
+
+    src_files = unity_sources(target, src_files, bin_dir / "unity", ".c" if target.type == "c" else ".cpp")
+    units = [(target.root / file, bin_dir / "obj" / file.with_suffix(".o")) for file in src_files]
+
+    compiled_files, errors = self._compile_files(target, compiler, args, units, deps, pch_inputs, batch_limit(target))
+
+    # units of a stopped build (--fail-fast) were not compiled, nothing is linked
+    if errors.has_errors() or JobScheduler.Get().cancelled: return errors
+
+    success(f"{GCCCompiler.NAME} {time.monotonic() - start:.2} sec compiles {target.label}")
+
+    if kind == "exe":
+      exe = self._compile_exe(compiled_files, res.static_lib, bin_dir, target, deps)
+      return ExeCompileResult(exe)
+
+    elif kind == "lib":
+      # ar can not merge archives, so the dependency libraries are handed on to the final link instead
+      lib = self._compile_lib(compiled_files, bin_dir, target, deps)
+      return LibCompileResult(include_paths, [lib] + res.static_lib)
+
+    else: assert False
+
+  def _compile_files(self, target : Target, compiler : Program, args : list[str], units : list[tuple[Path, Path]], deps : DependencyDatabase, extra_inputs : list[Path] = [], batch : int = 1) -> tuple[list[Path], CompileError]:
+    scheduler = JobScheduler.Get()
+    running : dict[Future, tuple[list[tuple[Path, Path, list[str]]], Diagnostics]] = {}
+    stale : list[tuple[Path, Path, list[str]]] = []
+    objects : list[Path] = []
+
+    for source, obj in units:
+      command = args + ["-MMD", "-MF", str(obj.with_suffix(".d")), "-o", str(obj), str(source)]
+      objects.append(obj)
+
+      # nothing this unit depends on changed since the last compile, reuse the object
+      if deps.is_up_to_date(source, obj, " ".join(command), extra_inputs): continue
+
+      os.makedirs(obj.parent, exist_ok=True)
+      stale.append((source, obj, command))
+
+    errors = CompileError()
+    started = time.time_ns()
+    for units in compile_batches(stale, batch, scheduler.jobs):
+      diagnostics = Diagnostics(errors, self._parse_error)
+      # the units with the longest way to the end of the build start first
+      keys = DurationHistory.compile_keys([source for source, _, _ in units], target.configuration)
+      running[scheduler.submit(self._compile_batch, compiler, args, units, diagnostics, priority=history.priority(target.label, keys), keys=keys)] = (units, diagnostics)
+
+    total = len(stale)
+    file_count = 0
+    for process in as_completed(running):
+      if process.cancelled(): continue # never started, the build was stopped
+      units, diagnostics = running[process]
+      for (source, obj, command), (_, err, code) in zip(units, process.result()):
+        file_count += 1
+        if code:
+          objects.remove(obj)
+          # killed because the build was stopped, not broken
+          if scheduler.cancelled and not diagnostics.failed: continue
+          # crashed or killed without a diagnostic (e.g. after a timeout), the unit still failed
+          if not diagnostics.fail() or (code == ProcessEngine.TIMEOUT_CODE and not scheduler.cancelled): errors.add_error(source, 0, err.strip(), f"exit code {code}")
+
+        else:
+          deps.record(source, obj, " ".join(command), self._read_depfile(obj.with_suffix(".d")) + extra_inputs, started)
+          print(f"\r[{file_count}/{total}] {source.name:50}", end="\r")
+
+    return objects, errors
+
+  def _compile_batch(self, compiler : Program, args : list[str], units : list[tuple[Path, Path, list[str]]], diagnostics : Diagnostics) -> list[tuple[str, str, int]]:
+    if len(units) == 1: return [self._compile_unit(compiler, args, *units[0], diagnostics)]
+
+    # without -o the driver writes <stem>.o and <stem>.d into its working directory, the output folder of the batch
+    sources = [source for source, _, _ in units]
+    with trace.span(f"{len(units)} files", "compile", source=str(sources[0].parent), sources=[str(source) for source in sources]) as event:
+      start = time.time_ns()
+      process = compiler.run_static(args + ["-MMD"] + [str(source) for source in sources], cwd=units[0][1].parent, on_output=diagnostics)
+      event["pid"] = process.pid()
+      _, err, code = process.wait()
+
+    # diagnostics start with "<source>:" or with an include chain ending in "from <source>:<line>",
+    # the lines of a chain belong to the source it ends in
+    sections : dict[Path, list[str]] = { source : [] for source in sources }
+    current, chain = None, []
+    for line in err.splitlines():
+      location = line.removeprefix("In file included from ").lstrip().removeprefix("from ")
+      owner = next((source for source in sources if location.startswith(str(source) + ":")), None)
+      chain.append(line)
+      if owner is None and (line.startswith("In file included from ") or (len(chain) > 1 and line.lstrip().startswith("from "))): continue
+      current = owner or current
+      if current is not None: sections[current].extend(chain)
+      chain = []
+
+    # a unit of a failed batch still succeeded if its object was written by this invocation
+    written = lambda obj: os.path.isfile(obj) and os.stat(obj).st_mtime_ns >= start
+    return [("", "\n".join(sections[source]), 0 if code == 0 or written(obj) else 1) for source, obj, _ in units]
+
+  def _compile_unit(self, compiler : Program, args : list[str], source : Path, obj : Path, command : list[str], diagnostics : Diagnostics) -> tuple[str, str, int]:
+    with trace.span(source.name, "compile", source=str(source)) as event:
+      return self._compile_cached(compiler, args, source, obj, command, event, diagnostics)
+
+  def _compile_cached(self, compiler : Program, args : list[str], source : Path, obj : Path, command : list[str], event : dict, diagnostics : Diagnostics) -> tuple[str, str, int]:
+    # only the real compile streams its diagnostics, the preprocessor run repeats them otherwise
+    compile = lambda: self._run(compiler, command, event, diagnostics)
+    cache, workers = ObjectCache.instance, WorkerPool.instance
+    # precompiled headers (and the header compile itself) are neither cached nor compiled remotely
+    if (cache is None and workers is None) or any(arg in ("-x", "-include", "-include-pch") for arg in args):
+      return compile()
+
+    preprocessed, _, code = compiler.run_static(args + ["-E", "-MMD", "-MF", str(obj.with_suffix(".d")), "-MT", str(obj), str(source)]).wait()
+    if code: return compile() # the real compile reports the errors
+
+    key = None
+    if cache is not None:
+      # include paths differ between checkouts, the preprocessed source already covers their effect
+      key = cache.key(compiler, [arg for arg in args if not arg.startswith("-I")], self._relocate(preprocessed, source, args))
+      if cache.fetch(key, obj): return "", "", 0
+
+    out, err, code = self._compile_remote(compiler, args, source, obj, preprocessed, event) or compile()
+    if code == 0 and key is not None: cache.store(key, obj)
+    return out, err, code
+
+  def _relocate(self, preprocessed : str, source : Path, args : list[str]) -> str:
+    # the line markers stay (-g writes their line numbers into the object), only the folder of the
+    # source, the include folders and the working directory are replaced by their position, which
+    # is the same in every checkout
+    folders = [os.path.join(os.path.abspath(folder), "") for folder in [source.parent] + [arg[2:] for arg in args if arg.startswith("-I")] + [os.getcwd()]]
+    def relocate(match : re.Match) -> str:
+      owners = [index for index, folder in enumerate(folders) if match.group(2).startswith(folder)]
+      if not owners: return match.group(0)
+      index = max(owners, key=lambda index: len(folders[index]))
+      return f"{match.group(1)}<{index}>/{match.group(2)[len(folders[index]):]}{match.group(3)}"
+    return GCCCompiler.LINE_MARKER.sub(relocate, preprocessed)
+
+  def _compile_remote(self, compiler : Program, args : list[str], source : Path, obj : Path, preprocessed : str, event : dict) -> tuple[str, str, int] | None:
+    if WorkerPool.instance is None: return None
+
+    # defines and include paths are already applied, the line markers keep the diagnostics pointing at the real files
+    flags = [arg for arg in args if not arg.startswith(("-I", "-D"))]
+    # workers refuse everything but code generation flags
+    if not all(allowed(flag) for flag in flags): return None
+    result = WorkerPool.instance.compile("c++" if compiler is self.cxx else "c", compiler_version(compiler), flags, source.name, preprocessed)
+    # the local compiler has the last word on errors, a failed remote compile is repeated locally
+    if result is None or result[1] != 0: return None
+
+    worker, _, data, err = result
+    with open(obj.with_suffix(obj.suffix + ".tmp"), "wb") as fp: fp.write(data)
+    os.replace(obj.with_suffix(obj.suffix + ".tmp"), obj)
+    event["worker"] = str(worker)
+    return "", err, 0
+
+  def _run(self, program : Program, command : list[str], event : dict, diagnostics : Diagnostics = None) -> tuple[str, str, int]:
+    process = program.run_static(command, on_output=diagnostics)
+    event["pid"] = process.pid()
+    return process.wait()
+
+  def _read_depfile(self, depfile : Path) -> list[Path]:
+    # make syntax "obj: source header header \ <newline> header", spaces in paths are escaped
+    try:
+      with open(depfile, "r") as fp: content = fp.read()
+    except OSError: return []
+
+    content = content.replace("\\\r\n", " ").replace("\\\n", " ")
+    _, _, content = content.partition(": ")
+    files = re.findall(r'((?:\\.|[^\s\\])+)', content)
+    return [Path(re.sub(r'\\(.)', r'\1', file)) for file in files]
+
+  def _compile_exe(self, compiled : list[Path], libs : list[str], out_path : Path, target : Target, deps : DependencyDatabase) -> Path:
+    out_path = out_path / (target.name + (".exe" if sys.platform == "win32" else ""))
+    inputs = compiled + [Path(lib) for lib in libs]
+    libs = [str(lib) for lib in libs]
+    if libs and sys.platform != "darwin": libs = ["-Wl,--start-group"] + libs + ["-Wl,--end-group"]
+    cmd = ["-o", str(out_path)] + [str(comp) for comp in compiled] + libs
+
+    # no object or library changed since the last link
+    if deps.is_linked(out_path, " ".join(cmd), inputs): return out_path
+
+    keys = DurationHistory.link_keys(target.label)
+    _, err, code = JobScheduler.Get().run(self.cxx, cmd, name=f"link {target.label}", category="link", priority=history.priority(target.label, keys, link=True), keys=keys).result()
+
+    if code:
+      print(err)
+      exit(1)
+
+    deps.record_link(out_path, " ".join(cmd), inputs)
+    return out_path
+
+  def _compile_lib(self, compiled : list[Path], out_path : Path, target : Target, deps : DependencyDatabase) -> str:
+    out_path = out_path / ("lib" + target.name + ".a")
+    cmd = ["rcs", str(out_path)] + [str(comp) for comp in compiled]
+    # no object changed since the last archive
+    if deps.is_linked(out_path, " ".join(cmd), compiled): return str(out_path)
+
+    # ar only adds and replaces members, objects of deleted sources would stay in an existing archive
+    if os.path.exists(out_path): os.remove(out_path)
+
+    keys = DurationHistory.link_keys(target.label)
+    _, err, code = JobScheduler.Get().run(self.ar, cmd, name=f"ar {target.label}", category="link", priority=history.priority(target.label, keys, link=True), keys=keys).result()
+
+    if code:
+      print(err)
+      exit(1)
+
+    deps.record_link(out_path, " ".join(cmd), compiled)
+    return str(out_path)
+
+  def _parse_error(self, error : str) -> tuple[Path, CompileErrorEntry]:
+    match = GCCCompiler.ERROR_PATTERN.search(error)
+    if not match:
+      return None, None
+
+    return Path(match.group(1)), CompileErrorEntry(int(match.group(2)), match.group(3), match.group(4))
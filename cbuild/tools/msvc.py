@@ -1,11 +1,18 @@
-from collections import deque
+from concurrent.futures import Future, as_completed
 from pathlib import Path
 import sys
-from cbuild.compiler import CompileError, CompileErrorEntry, CompileResult, Compiler, ExeCompileResult, HeaderCompileResult, LibCompileResult, ObjCompileResult
+from cbuild.compiler import CompileError, CompileErrorEntry, CompileResult, Compiler, Diagnostics, ExeCompileResult, HeaderCompileResult, LibCompileResult, ObjCompileResult, batch_limit, compile_batches, find_sources
+from cbuild.depdb import DependencyDatabase
+from cbuild.history import DurationHistory
 from cbuild.log import panic, error, success
-from cbuild.processes import Process, Program, StaticProcess
+from cbuild.objcache import ObjectCache
+from cbuild.pch import precompiled_header
+from cbuild.processes import ProcessEngine, Program
 from cbuild.project import Target
-from glob import glob
+from cbuild.scheduler import JobScheduler
+from cbuild.unity import unity_sources
+from cbuild import history, trace
+import threading
 import time
 import os
 import re
@@ -13,23 +20,43 @@ import re
 class MSVCCompiler(Compiler):
   NAME = "MSVC"
   STD_LIBS = "kernel32.lib User32.lib gdi32.lib winspool.lib shell32.lib ole32.lib oleaut32.lib uuid.lib comdlg32.lib advapi32.lib opengl32.lib".split(" ")
+  INCLUDE_PREFIX = "Note: including file:"
+  # "file(line): error C2065: message" or "file(line,column): ...", the message may contain colons itself
+  ERROR_PATTERN = re.compile(r'^(.+?)\((\d+)(?:,\d+)?\):\s+(fatal error|error|warning)\s+(\w+):\s+(.+)$')
+  # '#line 12 "C:\\path\\file.h"' of /E, backslashes are escaped
+  LINE_MARKER = re.compile(r'^(\s*#line \d+ ")([^"]*)(".*)$', re.MULTILINE)
   
-  def __init__(self):
+  def __init__(self, environment : dict[str, str] = None):
     super().__init__(["c", "c++"])  
-    self.compiler = Program("cl.exe")
-    self.linker = Program("link.exe")
-    self.lib = Program("lib.exe")
+    # the tools of another platform run with the environment vcvarsall sets up for it
+    self.compiler = Program("cl.exe", response_style="msvc", env=environment)
+    self.linker = Program("link.exe", response_style="msvc", env=environment)
+    self.lib = Program("lib.exe", response_style="msvc", env=environment)
     self.is_valid = self.compiler.is_valid()
+    self._platforms : dict[str, MSVCCompiler] = {}
+    self._lock = threading.Lock()
 
+  def platform(self, arch : str | None) -> "MSVCCompiler":
+    # configurations with an arch (x86 next to x64) build with a compiler of their own
+    if not arch or arch == Compiler.arch: return self
+    with self._lock:
+      if arch not in self._platforms:
+        from cbuild.vstoolchain import VSInstallation
+        installation = VSInstallation.latest(VSInstallation.find_installations())
+        panic(installation is not None, f"No visual studio installation found to build for {arch}")
+        self._platforms[arch] = MSVCCompiler(installation.environment(arch))
+      return self._platforms[arch]
   
   def __call__(self, target : Target, res : LibCompileResult) -> CompileResult:
     assert target.type in self.type 
+    if (compiler := self.platform(target.get("arch", None))) is not self: return compiler(target, res)
     #  CL [option...] file... [option | file]... [lib...] [@command-file] [/link link-opt...]
     sources = target.get("sources", []) 
     include_paths = target.get("includes", [])
-    bin_dir = target.root / target.get("bin_dir", "bin/") / target.name
+    bin_dir = target.get_bin_dir()
     kind = target.get("kind", None)
     defines = target.get("defines", [])
+    flags = target.get("flags", [])
     debug = target.get("debug", False)
 
     # sources and includes
@@ -42,122 +69,221 @@ class MSVCCompiler(Compiler):
     if kind == "header": return HeaderCompileResult(includes=include_paths)
 
     # Compile arguments
-    defines = ["/D " + name for name in defines]
-    std_args = ["/nologo", "/c", "/Z7", "/EHsc"]
+    defines = ["/D" + name for name in defines]
+    std_args = ["/nologo", "/c", "/Z7", "/EHsc", "/showIncludes"]
     include_args = ["-I" + str(include) for include in include_paths]
-    args = std_args + defines + include_args
+    args = std_args + defines + (flags if isinstance(flags, list) else [flags]) + include_args
 
     # create bin dir if it does not exist
     os.makedirs(target.root / bin_dir, exist_ok=True)
 
     start = time.monotonic()
+    deps = DependencyDatabase.Get(bin_dir / "cbuild.deps")
+
+    src_files = find_sources(target, sources)
 
     compiled_pch : Path = ""
     compiled_files = []
-    if pch_data := target.get("precompiled_header", None):
+    pch_inputs = []
+    pch_source, pch_include = None, ""
+    if pch_data := precompiled_header(target, src_files, bin_dir / "pch", ".c" if target.type == "c" else ".cpp"):
       source = Path(pch_data["source"])
       header = Path(pch_data["header"])
       force_include = "force_include" in pch_data and pch_data["force_include"]
       
       pch_args = args + [f"/Yc{header.name}", f"/Fp{bin_dir / source.with_suffix(".pch")}"]
-      compiled, errors = self._compile_files(pch_args, target.root, [source], bin_dir)
+      with trace.span(f"pch {target.label}", "pch", header=str(header)):
+        compiled, errors = self._compile_files(target, pch_args, target.root, [source], bin_dir, deps)
 
-      if errors.has_errors(): return errors
+      if errors.has_errors() or JobScheduler.Get().cancelled: return errors
 
       pch_file = compiled[0]
       compiled_pch = pch_file.with_suffix(".obj")
+      pch_inputs = [pch_file.with_suffix(".pch")]
+      pch_source, pch_include = source, ("" if force_include else f"#include \"{header}\"\n")
       args += ([f"/FI{header}"] if force_include else []) + [f"/Yu{header}", f"/Fp{pch_file.with_suffix(".pch")}"]
         
-    src_files = [Path(file) for source in sources for file in glob(source, root_dir=target.root, recursive=True)]
+    # /Yu needs the pch header as the first include of every unity file
+    src_files = unity_sources(target, src_files, bin_dir / "unity", ".c" if target.type == "c" else ".cpp", [pch_source], pch_include)
 
-    compiled_files, errors = self._compile_files(args, target.root, src_files, bin_dir)
+    compiled_files, errors = self._compile_files(target, args, target.root, src_files, bin_dir, deps, pch_inputs, batch_limit(target))
 
-    if errors.has_errors(): return errors
+    # units of a stopped build (--fail-fast) were not compiled, nothing is linked
+    if errors.has_errors() or JobScheduler.Get().cancelled: return errors
 
-    success(f"{MSVCCompiler.NAME} {time.monotonic() - start:.2} sec compiles {target.name}")
+    success(f"{MSVCCompiler.NAME} {time.monotonic() - start:.2} sec compiles {target.label}")
 
     if kind == "exe": 
       files = compiled_files + res.pch_files + res.static_lib + MSVCCompiler.STD_LIBS
-      exe = self._compile_exe(files, bin_dir, target.name)
+      exe = self._compile_exe(files, bin_dir, target, deps)
       return ExeCompileResult(exe)
     
     elif kind == "lib":
-      lib = self._compile_lib(compiled_files + res.static_lib, bin_dir, target.name)
+      lib = self._compile_lib(compiled_files + res.static_lib, bin_dir, target, deps)
       lib.includes = include_paths
       if compiled_pch != "": lib.pch_files = [compiled_pch]
       return lib
     
     else: assert False
 
-  def _compile_files(self, args : list[str], root : Path, files : list[Path], bin_folder : Path) -> tuple[list[Path], CompileError]:
+  def _compile_files(self, target : Target, args : list[str], root : Path, files : list[Path], bin_folder : Path, deps : DependencyDatabase, extra_inputs : list[Path] = [], batch : int = 1) -> tuple[list[Path], CompileError]:
 
 
-    data : dict[int, Path]= {}
-    running : deque[StaticProcess] = deque()
-    command_args = " ".join(args) 
+    scheduler = JobScheduler.Get()
+    running : dict[Future, tuple[list[tuple[Path, Path, list[str]]], Diagnostics]] = {}
+    stale : list[tuple[Path, Path, list[str]]] = []
+    objects : list[Path] = []
 
     for file in files:
       output_file : Path = bin_folder / file.with_suffix("")
+      command = args + [f"/Fo{output_file.with_suffix(".obj")}", str(root / file)]
+      objects.append(output_file.with_suffix(".obj"))
+
+      # nothing this unit depends on changed since the last compile, reuse the object
+      if deps.is_up_to_date(root / file, output_file.with_suffix(".obj"), " ".join(command), extra_inputs): continue
+
       os.makedirs(Path(output_file).parent, exist_ok=True)
-      command = command_args + f" /Fo{output_file.with_suffix(".obj")} {root / file}"
-      process = self.compiler.run_static(command)
-      running.appendleft(process)
-      data[process.pid()] = output_file.with_suffix(".obj")
+      stale.append((root / file, output_file.with_suffix(".obj"), command))
 
-    print(f"\r[0/{len(files)}] compiling {str(root):50}", end = "\r")
-    file_count = 0
     errors = CompileError()
-    # polling the compile status
-    while running and (process := running.popleft()):
+    started = time.time_ns()
+    for units in compile_batches(stale, batch, scheduler.jobs):
+      diagnostics = Diagnostics(errors, self._parse_error)
+      # the units with the longest way to the end of the build start first
+      keys = DurationHistory.compile_keys([source for source, _, _ in units], target.configuration)
+      running[scheduler.submit(self._compile_batch, args, units, diagnostics, priority=history.priority(target.label, keys), keys=keys)] = (units, diagnostics)
 
-      if not process.has_finished():
-        running.append(process)
-        continue
+    total = len(stale)
+    print(f"\r[0/{total}] compiling {str(root):50}", end = "\r")
+    file_count = 0
+    # blocks until the next compile of this batch exits
+    for process in as_completed(running):
+      if process.cancelled(): continue # never started, the build was stopped
+      units, diagnostics = running[process]
+      for (source, obj, command), (out, err, code) in zip(units, process.result()):
+        file_count += 1
+        out, includes = self._split_includes(out)
+        err, report = self._split_includes(err)
+        includes += report
+        if code:
+          objects.remove(obj)
+          # killed because the build was stopped, not broken
+          if scheduler.cancelled and not diagnostics.failed: continue
+          # crashed or killed without a diagnostic (e.g. after a timeout), the unit still failed
+          if not diagnostics.fail() or (code == ProcessEngine.TIMEOUT_CODE and not scheduler.cancelled): errors.add_error(source, 0, (out + err).strip(), f"exit code {code}")
 
-      file_count += 1
-      out, _, code = process.wait()
-      if code:
-        del data[process.pid()]
-        lines = list(reversed(out.splitlines()))
-        for line in lines:
-          file, entry = self._parse_error(line)
-          if file is not None: errors.add_entry(file, entry)
-
-      else:
-        print(f"\r[{file_count}/{len(files)}] {out.strip():50}", end="\r") # would like line replacement (maybe replace this in the future)
+        else:
+          deps.record(source, obj, " ".join(command), includes + extra_inputs, started)
+          print(f"\r[{file_count}/{total}] {out.strip():50}", end="\r") # would like line replacement (maybe replace this in the future)
         
-    return list(data.values()), errors
+    return objects, errors
   
+  def _compile_batch(self, args : list[str], units : list[tuple[Path, Path, list[str]]], diagnostics : Diagnostics) -> list[tuple[str, str, int]]:
+    if len(units) == 1: return [self._compile_unit(args, *units[0], diagnostics)]
+
+    # one cl.exe for several sources of the same output folder, objects keep the names of the single compiles
+    sources = [source for source, _, _ in units]
+    with trace.span(f"{len(units)} files", "compile", source=str(sources[0].parent), sources=[str(source) for source in sources]) as event:
+      start = time.time_ns()
+      process = self.compiler.run_static(args + [f"/Fo{units[0][1].parent}{os.sep}"] + [str(source) for source in sources], merge_output=True, on_output=diagnostics)
+      event["pid"] = process.pid()
+      out, _, code = process.wait()
+
+    # cl echoes the name of every source before its own includes and diagnostics
+    sections : dict[str, list[str]] = { source.name : [] for source in sources }
+    current = None
+    for line in out.splitlines():
+      if line.strip() in sections: current = line.strip()
+      elif current is not None: sections[current].append(line)
+
+    # a unit of a failed batch still succeeded if its object was written by this invocation
+    written = lambda obj: os.path.isfile(obj) and os.stat(obj).st_mtime_ns >= start
+    return [("\n".join(sections[source.name]), "", 0 if code == 0 or written(obj) else 1) for source, obj, _ in units]
+
+  def _compile_unit(self, args : list[str], source : Path, obj : Path, command : list[str], diagnostics : Diagnostics) -> tuple[str, str, int]:
+    with trace.span(source.name, "compile", source=str(source)) as event:
+      return self._compile_cached(args, source, obj, command, event, diagnostics)
+
+  def _compile_cached(self, args : list[str], source : Path, obj : Path, command : list[str], event : dict, diagnostics : Diagnostics) -> tuple[str, str, int]:
+    # only the real compile streams its diagnostics, the preprocessor run repeats them otherwise
+    compile = lambda: self._run(self.compiler, command, event, diagnostics)
+    cache = ObjectCache.instance
+    # objects built against a precompiled header are bound to that exact pch and can not be shared
+    if cache is None or any(arg.startswith(("/Yc", "/Yu")) for arg in args):
+      return compile()
 
-  def _compile_exe(self, compiled, out_path : Path, name : str) -> ExeCompileResult | CompileError:
-    out_path = out_path / (name + ".exe")
-    cmd = f"/nologo /debug /OUT:{out_path} {" ".join([str(comp) for comp in compiled])}"
+    preprocessed, report, code = self.compiler.run_static(args + ["/E", str(source)]).wait()
+    if code: return compile() # the real compile reports the errors
+
+    # include paths differ between checkouts, the preprocessed source already covers their effect
+    key = cache.key(self.compiler, [arg for arg in args if not arg.startswith(("-I", "/showIncludes"))], self._relocate(preprocessed, source, args))
+    if cache.fetch(key, obj): return "", report, 0
+
+    out, err, code = compile()
+    if code == 0: cache.store(key, obj)
+    return out, err, code
+
+  def _relocate(self, preprocessed : str, source : Path, args : list[str]) -> str:
+    # the #line markers stay (/Z7 writes their line numbers into the object), only the folder of the
+    # source, the include folders and the working directory are replaced by their position
+    folders = [os.path.normcase(os.path.join(os.path.abspath(folder), "")) for folder in [source.parent] + [arg[2:] for arg in args if arg.startswith("-I")] + [os.getcwd()]]
+    def relocate(match : re.Match) -> str:
+      path = os.path.normcase(match.group(2).replace("\\\\", "\\"))
+      owners = [index for index, folder in enumerate(folders) if path.startswith(folder)]
+      if not owners: return match.group(0)
+      index = max(owners, key=lambda index: len(folders[index]))
+      return f"{match.group(1)}<{index}>/{path[len(folders[index]):]}{match.group(3)}"
+    return MSVCCompiler.LINE_MARKER.sub(relocate, preprocessed)
+
+  def _run(self, program : Program, command : list[str], event : dict, diagnostics : Diagnostics = None) -> tuple[str, str, int]:
+    process = program.run_static(command, on_output=diagnostics)
+    event["pid"] = process.pid()
+    return process.wait()
+
+  def _split_includes(self, output : str) -> tuple[str, list[Path]]:
+    # /showIncludes interleaves the header report with the regular compiler output (stdout or stderr)
+    lines, includes = [], []
+    for line in output.splitlines():
+      if line.startswith(MSVCCompiler.INCLUDE_PREFIX): includes.append(Path(line[len(MSVCCompiler.INCLUDE_PREFIX):].strip()))
+      else: lines.append(line)
+    return "\n".join(lines), includes
+
+  def _compile_exe(self, compiled, out_path : Path, target : Target, deps : DependencyDatabase) -> ExeCompileResult | CompileError:
+    out_path = out_path / (target.name + ".exe")
+    cmd = ["/nologo", "/debug", f"/OUT:{out_path}"] + [str(comp) for comp in compiled]
+
+    # no object or library changed since the last link (system libraries are not fingerprinted)
+    if deps.is_linked(out_path, " ".join(cmd), compiled): return out_path
     
-    out, _, code = self.linker.run_static(cmd).wait()
+    keys = DurationHistory.link_keys(target.label)
+    out, _, code = JobScheduler.Get().run(self.linker, cmd, name=f"link {target.label}", category="link", priority=history.priority(target.label, keys, link=True), keys=keys).result()
 
     if code:
       print(out)
       exit(1)
 
+    deps.record_link(out_path, " ".join(cmd), compiled)
     return out_path
 
-  def _compile_lib(self, compiled, out_path : Path, name : str) -> LibCompileResult | CompileError:
-    out_path = out_path / (name + ".lib")
-    cmd = f"/nologo /debug /OUT:{out_path} {" ".join([str(comp) for comp in compiled])}"
-    out, _, code = self.lib.run_static(cmd).wait()
+  def _compile_lib(self, compiled, out_path : Path, target : Target, deps : DependencyDatabase) -> LibCompileResult | CompileError:
+    out_path = out_path / (target.name + ".lib")
+    cmd = ["/nologo", "/debug", f"/OUT:{out_path}"] + [str(comp) for comp in compiled]
+    if deps.is_linked(out_path, " ".join(cmd), compiled): return LibCompileResult([], str(out_path))
+
+    keys = DurationHistory.link_keys(target.label)
+    out, _, code = JobScheduler.Get().run(self.lib, cmd, name=f"lib {target.label}", category="link", priority=history.priority(target.label, keys, link=True), keys=keys).result()
     
     if code:
       print(out)
       exit(1)
 
+    deps.record_link(out_path, " ".join(cmd), compiled)
     return LibCompileResult([], str(out_path))
   
-  def _parse_error(self, error: list[str]) -> CompileErrorEntry:
-
-    compile_error_pattern = r'^(.+)\((\d+)\):\s+(.+)\s+(\w+):\s+(.+)$' 
-    
-    match = re.search(compile_error_pattern, error)
+  def _parse_error(self, error : str) -> tuple[Path, CompileErrorEntry]:
+    match = MSVCCompiler.ERROR_PATTERN.search(error)
     if not match:
       return None, None
-    
-    return Path(match.group(1)), CompileErrorEntry(int(match.group(2)), match.group(4), match.group(5))
\ No newline at end of file
+
+    # "file(line): fatal error C1083: message", the severity stays part of the code
+    return Path(match.group(1)), CompileErrorEntry(int(match.group(2)), f"{match.group(3)} {match.group(4)}", match.group(5))
\ No newline at end of file
@@ -0,0 +1,99 @@
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+from pathlib import Path
+from typing import Any
+
+_local = threading.local()
+
+def set_slot(slot : int):
+  # called by the job threads of the scheduler, their events are shown on the row of the slot
+  _local.slot = slot
+
+def get_slot() -> int | None:
+  return getattr(_local, "slot", None)
+
+# Collects chrome trace events (chrome://tracing, ui.perfetto.dev) while building. Job slots
+# of the scheduler are shown as threads 0..N, target threads get their own rows after them.
+class Tracer:
+  instance : "Tracer" = None
+  TARGET_TID = 1000
+
+  def __init__(self, file : Path) -> None:
+    self.file = Path(file)
+    self.events : list[dict[str, Any]] = []
+    self._start = time.perf_counter_ns()
+    self._lock = threading.Lock()
+    self._threads : dict[int, int] = {}
+
+  @staticmethod
+  def Init(file : str = None) -> "Tracer":
+    Tracer.instance = Tracer(file) if file else None
+    return Tracer.instance
+
+  def now(self) -> float:
+    return (time.perf_counter_ns() - self._start) / 1000
+
+  def _tid(self) -> int:
+    if (slot := get_slot()) is not None: return slot
+
+    with self._lock:
+      ident = threading.get_ident()
+      if ident not in self._threads:
+        self._threads[ident] = Tracer.TARGET_TID + len(self._threads)
+        self.events.append({ "name" : "thread_name", "ph" : "M", "pid" : os.getpid(), "tid" : self._threads[ident], "args" : { "name" : threading.current_thread().name } })
+      return self._threads[ident]
+
+  @contextmanager
+  def span(self, name : str, category : str, **args):
+    # the yielded dict can be filled while the span is open (e.g. with the pid of a started process)
+    tid, start = self._tid(), self.now()
+    try: yield args
+    finally:
+      if (slot := get_slot()) is not None: args["slot"] = slot
+      event = { "name" : name, "cat" : category, "ph" : "X", "ts" : start, "dur" : self.now() - start, "pid" : os.getpid(), "tid" : tid, "args" : args }
+      with self._lock: self.events.append(event)
+
+  def instant(self, name : str, category : str, **args):
+    event = { "name" : name, "cat" : category, "ph" : "i", "s" : "t", "ts" : self.now(), "pid" : os.getpid(), "tid" : self._tid(), "args" : args }
+    with self._lock: self.events.append(event)
+
+  def write(self):
+    slots = { event["tid"] for event in self.events if event["tid"] < Tracer.TARGET_TID }
+    names = [{ "name" : "thread_name", "ph" : "M", "pid" : os.getpid(), "tid" : slot, "args" : { "name" : f"job slot {slot}" } } for slot in sorted(slots)]
+
+    os.makedirs(self.file.absolute().parent, exist_ok=True)
+    with open(self.file, "w") as fp:
+      json.dump({ "traceEvents" : names + self.events, "displayTimeUnit" : "ms" }, fp)
+
+  def summary(self, count : int = 10) -> str:
+    compiles = sorted([e for e in self.events if e["ph"] == "X" and e["cat"] == "compile"], key=lambda e: -e["dur"])
+    targets = { e["name"] : e for e in self.events if e["ph"] == "X" and e["cat"] == "target" }
+    cache = [e["name"] for e in self.events if e["ph"] == "i" and e["cat"] == "cache"]
+
+    lines = [f"Slowest translation units ({len(compiles)} compiled, {cache.count("up to date")} up to date, {cache.count("hit")} cache hits, {cache.count("miss")} misses):"]
+    lines += [f"  {e["dur"] / 1e6:8.3f}s  {e["args"].get("source", e["name"])}" for e in compiles[:count]]
+
+    lines += ["Slowest targets:"]
+    lines += [f"  {e["dur"] / 1e6:8.3f}s  {e["name"]}" for e in sorted(targets.values(), key=lambda e: -e["dur"])[:count]]
+
+    # walk back from the last target to finish, always following the dependency that finished last
+    path = []
+    current = max(targets.values(), key=lambda e: e["ts"] + e["dur"]) if targets else None
+    while current is not None:
+      path.append(current)
+      depends = [targets[name] for name in current["args"].get("depends", []) if name in targets]
+      current = max(depends, key=lambda e: e["ts"] + e["dur"]) if depends else None
+
+    total = sum(e["dur"] for e in path) / 1e6
+    lines += [f"Critical path ({total:.3f}s):"]
+    lines += [f"  {e["dur"] / 1e6:8.3f}s  {e["name"]}" for e in reversed(path)]
+    return "\n".join(lines)
+
+def span(name : str, category : str, **args):
+  return Tracer.instance.span(name, category, **args) if Tracer.instance is not None else nullcontext(args)
+
+def instant(name : str, category : str, **args):
+  if Tracer.instance is not None: Tracer.instance.instant(name, category, **args)
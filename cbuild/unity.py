@@ -0,0 +1,60 @@
+import hashlib
+import os
+from fnmatch import fnmatch
+from pathlib import Path
+from cbuild.project import Target
+from cbuild.util import write_if_changed
+
+# Unity (jumbo) builds: the sources of a target are grouped into generated files that just
+# #include their members, so shared headers are parsed once per batch instead of once per file.
+#
+#   unity: true | { count: 8, bytes: 262144, exclude: ["src/legacy/*.cpp"] }
+#
+# Batch boundaries are picked from a hash of the file paths (content defined chunking), so
+# adding, removing or editing a file only changes the batch it belongs to.
+DEFAULT_COUNT = 8
+
+def _hash(path : Path) -> int:
+  return int.from_bytes(hashlib.sha1(path.as_posix().encode()).digest()[:8], "little")
+
+def batches(files : list[Path], count : int, max_bytes : int = None, root : Path = Path(".")) -> list[list[Path]]:
+  result, batch, size = [], [], 0
+  for file in sorted(files, key=lambda file: file.as_posix()):
+    batch.append(file)
+    size += os.path.getsize(root / file) if max_bytes else 0
+
+    # on average every count-th file ends a batch, batches never grow over twice that
+    if _hash(file) % count == 0 or len(batch) >= 2 * count or (max_bytes and size >= max_bytes):
+      result.append(batch)
+      batch, size = [], 0
+
+  return result + ([batch] if batch else [])
+
+def unity_sources(target : Target, files : list[Path], folder : Path, extension : str, exclude : list[Path] = [], prefix : str = "") -> list[Path]:
+  settings = target.get("unity", False)
+  if not settings: return files
+
+  settings = settings if isinstance(settings, dict) else {}
+  count = max(1, int(settings.get("count", DEFAULT_COUNT)))
+  patterns = settings.get("exclude", [])
+  patterns = patterns if isinstance(patterns, list) else [patterns]
+
+  # files marked as incompatible (and e.g. the pch source) are still compiled on their own
+  excluded = lambda file: file in exclude or any(fnmatch(file.as_posix(), pattern) for pattern in patterns)
+  single = [file for file in files if excluded(file)]
+  grouped = batches([file for file in files if not excluded(file)], count, settings.get("bytes", None), target.root)
+
+  os.makedirs(folder, exist_ok=True)
+  sources = []
+  for batch in grouped:
+    if len(batch) == 1:
+      sources += batch
+      continue
+
+    unity = folder / f"unity_{_hash(batch[0]):016x}{extension}"
+    content = prefix + "".join(f"#include \"{(target.root / file).as_posix()}\"\n" for file in batch)
+
+    write_if_changed(unity, content)
+    sources.append(unity)
+
+  return sources + single
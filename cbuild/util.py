@@ -1,21 +1,72 @@
 
-import asyncio
 import os
+import time
 from pathlib import Path
-from typing import Any, Callable
+from typing import Callable
 import hashlib
 import concurrent.futures
+from cbuild.cache import CacheFile
 
-def hash_folder(folder : Path, hash_fn : Callable = hashlib.sha256, exclude = {}) -> str:
+CHUNK_SIZE = 1 << 20
+# files modified this recently might still change within the same mtime tick, never trust their stat
+RACY_WINDOW_NS = 2_000_000_000
 
-  hash = hashlib.sha256()
-  files = [Path(root) / filename for root, _, files in os.walk(folder) for filename in files]
-  
-  for file in files:
-    if file.suffix in exclude: continue
-    if not file.is_file(): continue 
-    with open(file, "rb") as fp:
-        hash.update(fp.read())
+def fingerprint(path : Path) -> list[int] | None:
+  try: stat = os.stat(path)
+  except OSError: return None
+  return [stat.st_size, stat.st_mtime_ns]
 
+def write_if_changed(file : Path, content : str) -> bool:
+  # generated files keep their mtime when the content is the same, so nothing depending on them rebuilds
+  if os.path.isfile(file):
+    with open(file, "r") as fp:
+      if fp.read() == content: return False
+
+  with open(file, "w") as fp: fp.write(content)
+  return True
+
+def hash_file(file : Path, hash_fn : Callable = hashlib.sha256) -> str:
+  hash = hash_fn()
+  with open(file, "rb") as fp:
+    while chunk := fp.read(CHUNK_SIZE): hash.update(chunk)
   return hash.hexdigest()
 
+def list_files(folder : Path, exclude = {}) -> list[Path]:
+  # exclude matches file / folder names (".cache", ".git") as well as suffixes (".obj")
+  excluded = lambda name: name in exclude or os.path.splitext(name)[1] in exclude
+
+  files = []
+  for root, folders, filenames in os.walk(folder):
+    folders[:] = sorted(name for name in folders if not excluded(name))
+    files += [Path(root) / name for name in sorted(filenames) if not excluded(name)]
+  return files
+
+def hash_folder(folder : Path, hash_fn : Callable = hashlib.sha256, exclude = {}, index : CacheFile = None) -> str:
+  # with an index, files whose (size, mtime, inode) did not change since the last call are not read again
+  algorithm = hash_fn().name
+  known = index.items() if index is not None else {}
+
+  digests : dict[Path, str] = {}
+  stats : dict[Path, list] = {}
+  for file in list_files(folder, exclude):
+    try: stat = os.stat(file)
+    except OSError: continue
+
+    stats[file] = [stat.st_size, stat.st_mtime_ns, stat.st_ino, algorithm]
+    entry = known.get(str(file), None)
+    if entry is not None and entry[:4] == stats[file]: digests[file] = entry[4]
+
+  stale = [file for file in stats if file not in digests]
+  with concurrent.futures.ThreadPoolExecutor() as pool:
+    digests.update(zip(stale, pool.map(lambda file: hash_file(file, hash_fn), stale)))
+
+  if index is not None and stale:
+    now = time.time_ns()
+    index.update({ str(file) : stats[file] + [digests[file]] for file in stale if now - stats[file][1] > RACY_WINDOW_NS })
+
+  hash = hash_fn()
+  for file in stats:
+    hash.update(Path(os.path.relpath(file, folder)).as_posix().encode())
+    hash.update(digests[file].encode())
+
+  return hash.hexdigest()
@@ -1,5 +1,6 @@
 import json
 import os
+import sqlite3
 import time
 from typing import Self
 from pathlib import Path
@@ -8,14 +9,14 @@ from cbuild.log import log
 from cbuild.compiler import Compiler
 from cbuild.processes import Program
 from cbuild.project import Target
+from cbuild.util import fingerprint
 
-from cbuild.tools.msvc import MSVCCompiler
-from cbuild.tools.cmake import CMakeCompiler
-
-from cbuild import CBUILD_INSTALL_DIR  
+from cbuild import CBUILD_USER_DIR
 
 class VSInstallation():
-  CACHE_FILE = Path(CBUILD_INSTALL_DIR) / "vswhere.ch"
+  CACHE_FILE = Path(CBUILD_USER_DIR) / "vswhere.ch"
+  _cache = None
+  base_environment : dict[str, str] = None # before the first activation
   def __init__(self, name : str, path : str, version : str, isPreview : str, update_date : str) -> None:
     self.name : str = name
     self.path : Path = Path(path)
@@ -31,15 +32,42 @@ class VSInstallation():
 
     log(f"Initializing {self.name} {".".join([str(i) for i in self.version])}")
 
-    cache = CacheFile(VSInstallation.CACHE_FILE)
+    if VSInstallation.base_environment is None: VSInstallation.base_environment = dict(os.environ)
+    VSInstallation._apply(os.environ, self._updates(platform))
+
+    self.is_activated = True
+    Compiler.arch = platform
+
+  def environment(self, platform : str) -> dict[str, str]:
+    # the environment of another platform (x86 next to x64), os.environ stays as it is
+    return VSInstallation._apply(dict(VSInstallation.base_environment or os.environ), self._updates(platform))
+
+  @staticmethod
+  def _open_cache() -> CacheFile | None:
+    # without a writable cache folder vswhere and vcvarsall run on every start
+    if VSInstallation._cache is None:
+      try: VSInstallation._cache = CacheFile(VSInstallation.CACHE_FILE)
+      except (OSError, sqlite3.Error): VSInstallation._cache = False
+    return VSInstallation._cache if VSInstallation._cache is not False else None
+
+  @staticmethod
+  def _store(key : str, value):
+    if (cache := VSInstallation._open_cache()) is None: return
+    try: cache[key] = value
+    except sqlite3.Error: pass # read only
+
+  def _updates(self, platform : str) -> dict[str, list[str]]:
+    # what vcvarsall adds to the environment cbuild started with
+    cache = VSInstallation._open_cache()
     conf_hash = self.hash + platform
+    base = VSInstallation.base_environment or dict(os.environ)
 
     update_environ = {}
-    if conf_hash not in cache:
-      vcvars = Program(self.path / "VC/Auxiliary/Build/vcvarsall.bat")
+    if cache is None or conf_hash not in cache:
+      vcvars = Program(self.path / "VC/Auxiliary/Build/vcvarsall.bat", env=base)
       assert vcvars.is_valid(), "Failed set up the environment"
       
-      out, _, _ = vcvars.run_static(f"{platform} 1>&2 && set").wait()
+      out, _, _ = vcvars.run_static([platform, "1>&2", "&&", "set"]).wait()
 
       # TODO check err output
       for line in out.splitlines():
@@ -48,7 +76,7 @@ class VSInstallation():
         line = line.split("=", 1)
         name, content = line[0], list(split(line[1], ";"))
         
-        original = list(split(os.environ[name], ";")) if name in os.environ else []
+        original = list(split(base[name], ";")) if name in base else []
 
         result = [element for element in content if element not in original]
         
@@ -58,22 +86,36 @@ class VSInstallation():
     else:
       update_environ = cache[conf_hash]
 
-    for key, content in update_environ.items(): 
-      os.environ[key] = ";".join([str(var) for var in content]) + (os.environ[key] if key in os.environ else "")
+    VSInstallation._store(conf_hash, update_environ) # update cache
+    return update_environ
 
-    cache[conf_hash] = update_environ # update cache
-
-    self.is_activated = True
-    Compiler.arch = platform
+  @staticmethod
+  def _apply(environment, update_environ : dict[str, list[str]]):
+    for key, content in update_environ.items(): 
+      environment[key] = ";".join([str(var) for var in content]) + (environment[key] if key in environment else "")
+    return environment
 
   
+  @staticmethod
+  def latest(installations : list["VSInstallation"]) -> "VSInstallation":
+    stable = [installation for installation in installations if not installation.ispreview]
+    return max(stable, key=lambda installation: installation.version) if stable else None
+
   @staticmethod
   def find_installations() -> list["VSInstallation"]:
-    # cache this in a file
     program_files_path : str = os.getenv("PROGRAMFILES(X86)") or ""
     vswhere = Program(program_files_path + "/Microsoft Visual Studio/Installer/vswhere.exe")
     if not vswhere.is_valid(): return []
 
-    output, _, _ = vswhere.run_static("-all -format json -utf8 -nocolor").wait()
+    # the installer rewrites its instance folder whenever visual studio is installed, updated or removed
+    instances = Path(os.getenv("PROGRAMDATA") or "") / "Microsoft/VisualStudio/Packages/_Instances"
+    stamp = [fingerprint(vswhere.program), fingerprint(instances)]
+
+    cache = VSInstallation._open_cache()
+    if cache is not None and (entry := cache["vswhere"]) is not None and entry["stamp"] == stamp:
+      output = entry["output"]
+    else:
+      output, _, _ = vswhere.run_static(["-all", "-format", "json", "-utf8", "-nocolor"]).wait()
+      VSInstallation._store("vswhere", { "stamp" : stamp, "output" : output })
 
     return [VSInstallation(x["displayName"], x["installationPath"], x["installationVersion"], x["isPrerelease"], x["updateDate"]) for x in json.loads(output)]
\ No newline at end of file
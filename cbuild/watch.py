@@ -0,0 +1,241 @@
+import abc
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import sys
+import threading
+import time
+from concurrent.futures import CancelledError
+from pathlib import Path
+from cbuild.compiler import Compiler, CompileResult, forget_sources
+from cbuild.depdb import DependencyDatabase
+from cbuild.graph import BuildGraph
+from cbuild.history import DurationHistory
+from cbuild.log import log, success, warn, error
+from cbuild.project import Project, Target
+from cbuild.scheduler import JobScheduler
+from cbuild.util import fingerprint
+
+IGNORED_NAMES = { ".git", ".cbuild", "__pycache__" }
+
+# Reports the files that changed below a set of folders. Ignored folders (the build
+# outputs of the targets) are not watched, so a build never triggers the next one.
+class Watcher(abc.ABC):
+  def __init__(self, folders : list[Path], ignored : set[Path]) -> None:
+    self.folders = folders
+    self.ignored = ignored
+
+  @staticmethod
+  def Create(folders : list[Path], ignored : set[Path]) -> "Watcher":
+    if sys.platform.startswith("linux"):
+      try: return InotifyWatcher(folders, ignored)
+      except OSError as e: warn(f"inotify is not available ({e}), polling for changes instead")
+    return PollingWatcher(folders, ignored)
+
+  @staticmethod
+  def ForTargets(targets : list[Target]) -> "Watcher":
+    # the folders of all targets, without nested ones and without their build outputs
+    roots = { Path(os.path.abspath(target.root)) for target in targets }
+    folders = [root for root in roots if not any(other in root.parents for other in roots)]
+    ignored = { Path(os.path.abspath(target.get_output_dir())) for target in targets }
+    return Watcher.Create(folders, ignored)
+
+  def is_ignored(self, path : Path) -> bool:
+    return path.name in IGNORED_NAMES or path in self.ignored
+
+  def _walk(self, folder : Path):
+    for root, folders, files in os.walk(folder):
+      folders[:] = [name for name in folders if not self.is_ignored(Path(root) / name)]
+      yield Path(root), files
+
+  @abc.abstractmethod
+  def poll(self, timeout : float | None) -> set[Path]:
+    # the files that changed, empty once the timeout passed without a change
+    pass
+
+  def changes(self, debounce : float) -> set[Path]:
+    # blocks until something changed, then waits for the burst to end (editors save in
+    # several steps, a git checkout touches many files) so it results in a single build
+    changed = set()
+    while not changed: changed = self.poll(None)
+    while more := self.poll(debounce): changed |= more
+    return changed
+
+  def pending(self) -> set[Path]:
+    # everything that changed since the last call, without waiting
+    changed = set()
+    while more := self.poll(0): changed |= more
+    return changed
+
+  def close(self):
+    pass
+
+class InotifyWatcher(Watcher):
+  IN_ATTRIB, IN_CLOSE_WRITE, IN_MOVED_FROM, IN_MOVED_TO, IN_CREATE, IN_DELETE = 0x4, 0x8, 0x40, 0x80, 0x100, 0x200
+  IN_Q_OVERFLOW, IN_IGNORED, IN_ISDIR = 0x4000, 0x8000, 0x40000000
+  IN_NONBLOCK, IN_CLOEXEC = 0o4000, 0o2000000
+  MASK = IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+  EVENT = struct.Struct("iIII") # wd, mask, cookie, length of the name that follows
+
+  def __init__(self, folders : list[Path], ignored : set[Path]) -> None:
+    super().__init__(folders, ignored)
+    self.libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+    self.fd = self.libc.inotify_init1(InotifyWatcher.IN_NONBLOCK | InotifyWatcher.IN_CLOEXEC)
+    if self.fd < 0: raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+
+    # inotify is not recursive, every folder gets its own watch
+    self.watches : dict[int, Path] = {}
+    for folder in folders:
+      for root, _ in self._walk(folder): self._add(root)
+
+  def _add(self, folder : Path):
+    wd = self.libc.inotify_add_watch(self.fd, os.fsencode(folder), InotifyWatcher.MASK)
+    if wd < 0:
+      self.close()
+      raise OSError(ctypes.get_errno(), f"can not watch {folder}")
+    self.watches[wd] = folder
+
+  def poll(self, timeout : float | None) -> set[Path]:
+    readable, _, _ = select.select([self.fd], [], [], timeout)
+    if not readable: return set()
+
+    try: data = os.read(self.fd, 1 << 16)
+    except BlockingIOError: return set()
+
+    changed, offset = set(), 0
+    while offset < len(data):
+      wd, mask, _, length = InotifyWatcher.EVENT.unpack_from(data, offset)
+      name = os.fsdecode(data[offset + InotifyWatcher.EVENT.size : offset + InotifyWatcher.EVENT.size + length].rstrip(b"\0"))
+      offset += InotifyWatcher.EVENT.size + length
+
+      # events were dropped, anything could have changed
+      if mask & InotifyWatcher.IN_Q_OVERFLOW: changed |= set(self.folders)
+      if mask & InotifyWatcher.IN_IGNORED: self.watches.pop(wd, None)
+      if wd not in self.watches or not name: continue
+
+      path = self.watches[wd] / name
+      if self.is_ignored(path): continue
+
+      # a new (or moved in) folder is watched and everything already in it counts as changed
+      if mask & InotifyWatcher.IN_ISDIR and mask & (InotifyWatcher.IN_CREATE | InotifyWatcher.IN_MOVED_TO):
+        for root, files in self._walk(path):
+          self._add(root)
+          changed |= { root / file for file in files }
+
+      changed.add(path)
+    return changed
+
+  def close(self):
+    if self.fd >= 0: os.close(self.fd)
+    self.fd = -1
+
+class PollingWatcher(Watcher):
+  INTERVAL = 0.5
+
+  def __init__(self, folders : list[Path], ignored : set[Path]) -> None:
+    super().__init__(folders, ignored)
+    self.stamps = self._scan()
+
+  def _scan(self) -> dict[Path, list[int]]:
+    return { root / file : fingerprint(root / file) for folder in self.folders for root, files in self._walk(folder) for file in files }
+
+  def poll(self, timeout : float | None) -> set[Path]:
+    deadline = time.monotonic() + timeout if timeout is not None else None
+    while True:
+      time.sleep(min(timeout, PollingWatcher.INTERVAL) if timeout is not None else PollingWatcher.INTERVAL)
+      stamps = self._scan()
+      changed = { path for path in stamps.keys() | self.stamps.keys() if stamps.get(path) != self.stamps.get(path) }
+      self.stamps = stamps
+      if changed or (deadline is not None and time.monotonic() >= deadline): return changed
+
+# `cbuild watch`: the project, the toolchain and the stat results of the dependency databases
+# stay in memory between builds. A change only rebuilds the targets owning the changed files
+# and their dependents, a build still running when newer changes arrive is cancelled.
+class WatchSession:
+  DEBOUNCE = 0.2
+
+  def __init__(self, path : Path = Path("."), configurations : list[str] = None) -> None:
+    self.path = Path(path)
+    self.configurations = configurations
+    self.watcher : Watcher = None
+    self._thread : threading.Thread = None
+    self._cancelled = False
+    self._load()
+
+  def _load(self):
+    self.project = Project(self.path)
+    self.graph = BuildGraph(*self.project.get_start_targets(self.configurations))
+    Compiler.Init({ target.type for target in self.graph.targets })
+    self.results : dict[Target, CompileResult] = {} # targets that are up to date
+
+    self.roots = { target : Path(os.path.abspath(target.root)) for target in self.graph.targets }
+
+    if self.watcher is not None: self.watcher.close()
+    self.watcher = Watcher.ForTargets(self.graph.targets)
+
+  def affected(self, changes : set[Path]) -> set[Target]:
+    affected = set()
+    for path in changes:
+      # a file belongs to the target(s) with the closest root, a changed folder to all targets below it
+      owners = [root for root in self.roots.values() if root == path or root in path.parents]
+      closest = max(owners, key=lambda root: len(root.parts)) if owners else None
+      affected |= { target for target, root in self.roots.items() if root == closest or path in root.parents }
+
+    # dependents include the headers and link the libraries of what changed
+    for target in self.graph.targets:
+      if any(child in affected for child in target._dependencies): affected.add(target)
+    return affected
+
+  def run(self):
+    self._start()
+    while True:
+      changes = self.watcher.changes(WatchSession.DEBOUNCE)
+      self._cancel()
+
+      if any(path.name == "project.yaml" for path in changes):
+        log("Project changed, reloading")
+        DependencyDatabase.forget()
+        self._load()
+      else:
+        DependencyDatabase.forget(None if any(path in self.watcher.folders for path in changes) else changes, self.watcher.folders, self.watcher.ignored)
+        for target in self.affected(changes): self.results.pop(target, None)
+
+      self._start()
+
+  def _start(self):
+    if all(root in self.results for root in self.graph.roots): return # nothing that is part of the build changed
+
+    names = [target.label for target in self.graph.targets if target not in self.results]
+    log(f"Building {", ".join(names)}")
+
+    self._cancelled = False
+    JobScheduler.Get().resume()
+    self._thread = threading.Thread(target=self._build, args=(dict(self.results),), name="cbuild-watch", daemon=True)
+    self._thread.start()
+
+  def _cancel(self):
+    if self._thread is None or not self._thread.is_alive(): return
+
+    log("Newer changes, cancelling the running build")
+    self._cancelled = True
+    JobScheduler.Get().cancel()
+    self._thread.join()
+
+  def _build(self, previous : dict[Target, CompileResult]):
+    start = time.monotonic()
+    forget_sources()
+    DurationHistory.instance.plan(self.graph.targets)
+    try: result = self.graph.execute(Compiler.Compile, previous)
+    except (CancelledError, SystemExit): result = None # links report their own errors and exit
+    DurationHistory.instance.write()
+
+    # whatever a cancelled build produced is checked again by the next one
+    if self._cancelled: return
+    if result is not None:
+      self.results.update({ target : result for target, result in self.graph.results.items() if not result.error() })
+
+    if result is None or result.error(): error(result if result is not None else "Build failed", fatal=False)
+    else: success(f"Build took {time.monotonic() - start:.2f} seconds")
+    log("Watching for changes")
@@ -1,6 +1,6 @@
 from setuptools import setup, find_packages
 entry_points = {
-    'console_scripts': ['cbuild=cbuild.cbuild:main'],
+    'console_scripts': ['cbuild=cbuild.__main__:main'],
 }
 
 setup(